@@ -8,6 +8,14 @@ from os.path import join
 import math
 import random
 import shutil
+import json
+import errno
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+try:
+    import fcntl
+except ImportError:
+    # not on windows
+    fcntl = None
 #modules in files
 import dataset
 
@@ -60,11 +68,80 @@ def get_image_paths_in_dir(dir_path, save_dir):
 
     return(img_paths, img_ids)
 
+def get_xml_path(img_path):
+    xml_path = img_path.replace('chips_positive', 'chips_positive_xml')
+    return xml_path.replace("jpg","xml")
+
+def symlink(src, dst):
+    """
+    replace dst with a symbolic link to the absolute path of src
+    """
+    tmp_path = dst + ".tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(os.path.abspath(src), tmp_path)
+    os.replace(tmp_path, dst)
+
+def get_split_index_path(data_folder, split):
+    return os.path.join(data_folder, split + "_index.json")
+
+def write_split_index(data_folder, split, img_paths, img_ids):
+    """
+    save {image id: {"image": jpg path, "annotation": xml path}} of the images of a split, the absolute paths of the sources
+    """
+    index = {img_id: {"image": os.path.abspath(img_path), "annotation": os.path.abspath(get_xml_path(img_path))}
+             for img_path, img_id in zip(img_paths, img_ids)}
+    tmp_path = get_split_index_path(data_folder, split) + ".tmp"
+    with open(tmp_path, 'w') as j:
+        json.dump(index, j)
+    os.replace(tmp_path, get_split_index_path(data_folder, split))
+
+def load_split_index(data_folder, split):
+    """
+    load the index of a split saved by split_train_val_test(mode = "index"), returns None if there is none
+    """
+    if not os.path.isfile(get_split_index_path(data_folder, split)):
+        return None
+    with open(get_split_index_path(data_folder, split), 'r') as j:
+        return json.load(j)
+
+def materialize_split(data_folder, split, img_paths, img_ids, mode = "copy"):
+    """
+    Put the images and xmls of a split in <data_folder>/<split>/images and labels, as copies (mode "copy"), symbolic
+    links ("symlink") or hard links ("hardlink", copies across filesystems), or only write the index of their source paths
+    (mode "index", see write_split_index), which convert_voc_to_yolo reads instead of the split folders.
+    With links the files left over from an earlier split are removed, so the folders can be split again in place.
+    """
+    if mode == "index":
+        write_split_index(data_folder, split, img_paths, img_ids)
+        return
+    # the folders are the split now, not an index written by an earlier split
+    if os.path.isfile(get_split_index_path(data_folder, split)):
+        os.remove(get_split_index_path(data_folder, split))
+    destinations = set()
+    for img_path, img_id in zip(img_paths, img_ids):
+        for src, dst in [(img_path, os.path.join(data_folder, split, "images", img_id+".jpg")),
+                         (get_xml_path(img_path), os.path.join(data_folder, split, "labels", img_id+".xml"))]:
+            if mode == "copy":
+                shutil.copy(src, dst)
+            elif mode == "symlink":
+                symlink(src, dst)
+            else:
+                link_or_copy(src, dst, "hardlink")
+            destinations.add(dst)
+    if mode in ["symlink", "hardlink"]:
+        for sub_dir in ["images", "labels"]:
+            with os.scandir(os.path.join(data_folder, split, sub_dir)) as entries:
+                for entry in entries:
+                    if entry.path not in destinations and (entry.is_symlink() or mode == "hardlink"):
+                        os.remove(entry.path)
+
 def split_train_val_test(img_paths, seed, data_folder, save_dir,
-                         train_percent = 0.8, val_percent = 0.1):
+                         train_percent = 0.8, val_percent = 0.1, mode = "copy"):
     """
     get a text file of the ids for the train/val and test sets
     Percentage of trainval:test and train: validation 
+    mode: how the images and xmls of each set are put in data_folder, see materialize_split
     """
     #Calculate numbers of images that should be in the train/val and test sets   
     num_imgs = len(img_paths)  
@@ -88,24 +165,10 @@ def split_train_val_test(img_paths, seed, data_folder, save_dir,
     write_list(os.path.join(save_dir,"val_img_ids.txt"), val_img_ids)
     write_list(os.path.join(save_dir,"test_img_ids.txt"), test_img_ids)
 
-    # Copy-pasting images
-    for i, (img_path, img_id) in enumerate(zip(train_img_paths, train_img_ids)):
-        shutil.copy(img_path, os.path.join(data_folder, "train", "images", img_id+".jpg"))
-        xml_path = img_path.replace('chips_positive', 'chips_positive_xml')
-        xml_path = xml_path.replace("jpg","xml")
-        shutil.copy(xml_path, os.path.join(data_folder, "train", "labels", img_id+".xml"))
-        
-    for i, (img_path, img_id) in enumerate(zip(val_img_paths, val_img_ids)):
-        shutil.copy(img_path, os.path.join(data_folder, "val", "images", img_id+".jpg"))
-        xml_path = img_path.replace('chips_positive', 'chips_positive_xml')
-        xml_path = xml_path.replace("jpg","xml")
-        shutil.copy(xml_path, os.path.join(data_folder, "val", "labels", img_id+".xml"))
-        
-    for i, (img_path, img_id) in enumerate(zip(test_img_paths, test_img_ids)):
-        shutil.copy(img_path, os.path.join(data_folder, "test", "images", img_id+".jpg"))
-        xml_path = img_path.replace('chips_positive', 'chips_positive_xml')
-        xml_path = xml_path.replace("jpg","xml")
-        shutil.copy(xml_path, os.path.join(data_folder, "test", "labels", img_id+".xml"))
+    # Copy-pasting (or linking, or indexing) images
+    materialize_split(data_folder, "train", train_img_paths, train_img_ids, mode)
+    materialize_split(data_folder, "val", val_img_paths, val_img_ids, mode)
+    materialize_split(data_folder, "test", test_img_paths, test_img_ids, mode)
     
 def convert(size, box):
     dw = 1./(size[0])
@@ -120,24 +183,26 @@ def convert(size, box):
     h = h*dh
     return (x,y,w,h)
 
-def convert_annotation(img_id, dir_path, voc_data_dir, split, coco_data_dir, label_map):
+def get_conversion_paths(img_id, dir_path, voc_data_dir, split, coco_data_dir):
     """
-    Excludes objects labeled difficult from conversion 
+    the voc xml and jpg of an image, and the yolo txt and jpg they are converted to
     """
-    voc_path = os.path.join(dir_path, voc_data_dir, split, "labels", img_id+".xml")
-    in_file = open(voc_path)
-    #specify path for coco formated annotations
-    coco_path = voc_path.replace(voc_data_dir, coco_data_dir)
-    coco_path = coco_path.replace("xml", "txt")
-    out_file = open(coco_path, 'w')
-    
-    #parse files and re
-    tree = ET.parse(in_file)
-    root = tree.getroot()
+    return (os.path.join(dir_path, voc_data_dir, split, "labels", img_id+".xml"),
+            os.path.join(dir_path, voc_data_dir, split, "images", img_id+".jpg"),
+            os.path.join(dir_path, coco_data_dir, split, "labels", img_id+".txt"),
+            os.path.join(dir_path, coco_data_dir, split, "images", img_id+".jpg"))
+
+def yolo_label_lines(voc_path, label_map):
+    """
+    The lines of the yolo label file of a voc xml: "<class id> <x center> <y center> <width> <height>" (fractions of the
+    image size). Excludes objects labeled difficult from conversion
+    """
+    root = ET.parse(voc_path).getroot()
     size = root.find('size')
     w = int(size.find('width').text)
     h = int(size.find('height').text)
 
+    lines = []
     for obj in root.iter('object'):
         difficult = obj.find('difficult').text
         cls = obj.find('name').text
@@ -148,7 +213,23 @@ def convert_annotation(img_id, dir_path, voc_data_dir, split, coco_data_dir, lab
         b = (float(xmlbox.find('xmin').text), float(xmlbox.find('xmax').text), 
              float(xmlbox.find('ymin').text), float(xmlbox.find('ymax').text))
         bb = convert((w,h), b)
-        out_file.write(str(cls_id) + " " + " ".join([str(a) for a in bb]) + '\n')
+        lines.append(str(cls_id) + " " + " ".join([str(a) for a in bb]) + '\n')
+    return lines
+
+def write_label_file(path, lines):
+    """
+    write to a temporary file, renamed once complete, so an interrupted run never leaves a partial label file
+    """
+    with open(path + ".tmp", 'w') as out_file:
+        out_file.writelines(lines)
+    os.replace(path + ".tmp", path)
+
+def convert_annotation(img_id, dir_path, voc_data_dir, split, coco_data_dir, label_map):
+    """
+    Excludes objects labeled difficult from conversion 
+    """
+    voc_path, _, coco_path, _ = get_conversion_paths(img_id, dir_path, voc_data_dir, split, coco_data_dir)
+    write_label_file(coco_path, yolo_label_lines(voc_path, label_map))
       
     
 def copy_converted_images(img_id, dir_path, voc_data_dir, split, coco_data_dir):
@@ -159,6 +240,170 @@ def copy_converted_images(img_id, dir_path, voc_data_dir, split, coco_data_dir):
     coco_img_path = os.path.join(dir_path, coco_data_dir, split, "images", img_id+".jpg")
     shutil.copy(voc_img_path, coco_img_path)
 
+FICLONE = 0x40049409 # linux ioctl sharing the extents of a file (btrfs, xfs, ...)
+
+def reflink(src, dst):
+    """
+    copy-on-write clone of src to dst, raises OSError where the filesystem (or platform) does not support it
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks need fcntl")
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+def link_or_copy(src, dst, mode = "hardlink"):
+    """
+    Put a copy of src at dst: a hard link (mode "hardlink"), a copy-on-write reflink ("reflink") or a copy ("copy").
+    Links need src and dst on the same filesystem; a hard link falls back to a reflink, a reflink to a copy.
+    A hard link shares its contents with src, so the converted images must not be edited in place.
+    :return: the method used
+    """
+    tmp_path = dst + ".tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    methods = {"hardlink": ["hardlink", "reflink", "copy"], "reflink": ["reflink", "copy"], "copy": ["copy"]}[mode]
+    for method in methods:
+        try:
+            if method == "hardlink":
+                os.link(src, tmp_path)
+            elif method == "reflink":
+                reflink(src, tmp_path)
+            else:
+                shutil.copyfile(src, tmp_path)
+            break
+        except OSError:
+            if method == "copy":
+                raise
+    os.replace(tmp_path, dst)
+    return method
+
+def get_conversion_manifest_path(dir_path, coco_data_dir):
+    return os.path.join(dir_path, coco_data_dir, "conversion_manifest.jsonl")
+
+def get_source_record(voc_path, voc_img_path):
+    """
+    the (modification time, size) of the voc xml and jpg of an image, to tell whether they changed since their conversion
+    """
+    xml_stat = os.stat(voc_path)
+    img_stat = os.stat(voc_img_path)
+    return [xml_stat.st_mtime_ns, xml_stat.st_size, img_stat.st_mtime_ns, img_stat.st_size]
+
+def load_conversion_manifest(manifest_path):
+    """
+    The {(split, img_id): source record} of the images converted by earlier runs.
+    The manifest is a json lines file, appended to as the images are converted; a line cut by an interrupted run is removed
+    """
+    manifest = {}
+    if not os.path.isfile(manifest_path):
+        return manifest
+    with open(manifest_path, 'rb+') as f:
+        complete = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            record = json.loads(line)
+            manifest[(record['split'], record['id'])] = record['source']
+            complete += len(line)
+        f.truncate(complete)
+    return manifest
+
+def is_converted(manifest, split, img_id, paths):
+    """
+    an image is skipped if it is in the manifest, its voc files did not change since and its yolo files exist
+    """
+    voc_path, voc_img_path, coco_path, coco_img_path = paths
+    if (split, img_id) not in manifest or not (os.path.isfile(coco_path) and os.path.isfile(coco_img_path)):
+        return False
+    try:
+        return manifest[(split, img_id)] == get_source_record(voc_path, voc_img_path)
+    except OSError:
+        return False
+
+def convert_annotation_chunk(chunk_args):
+    """
+    Convert the annotations of a chunk of images, in a worker process
+    argument: a tuple of (split, image ids, their paths (see get_conversion_paths), label map)
+    returns: the split, the image ids, their paths and the source records of their voc files
+    """
+    split, img_ids, paths, label_map = chunk_args
+    records = []
+    for voc_path, voc_img_path, coco_path, _ in paths:
+        # stat before reading, so a file changed during the conversion is converted again by the next run
+        records.append(get_source_record(voc_path, voc_img_path))
+        write_label_file(coco_path, yolo_label_lines(voc_path, label_map))
+    return split, img_ids, paths, records
+
+def link_or_copy_chunk(paths, mode):
+    return [link_or_copy(voc_img_path, coco_img_path, mode) for _, voc_img_path, _, coco_img_path in paths]
+
+def convert_voc_to_yolo(dir_path, voc_data_dir, coco_data_dir, split_ids, label_map, num_workers = None, num_threads = 8,
+                        chunk_size = 256, image_mode = "hardlink", resume = True, voc_index = None):
+    """
+    Convert the voc annotations of the images of each split to yolo label files, and link or copy the images (see link_or_copy).
+    The xmls are parsed in chunks of chunk_size images by a process pool; the images of each parsed chunk are
+    linked or copied by a thread pool, while the next chunks are parsed. Each converted image is recorded in
+    <coco_data_dir>/conversion_manifest.jsonl, so with resume a rerun (e.g. after an interruption) skips the
+    images already converted whose voc files did not change.
+    :param split_ids: {split name: list of image ids}
+    :param voc_index: {split name: split index (see load_split_index)}, to read the voc files of these splits from their
+    source paths instead of the split folders
+    :return: the number of images converted, skipped, and linked or copied by each method
+    """
+    for split in split_ids:
+        os.makedirs(os.path.join(dir_path, coco_data_dir, split, "images"), exist_ok=True)
+        os.makedirs(os.path.join(dir_path, coco_data_dir, split, "labels"), exist_ok=True)
+    manifest_path = get_conversion_manifest_path(dir_path, coco_data_dir)
+    manifest = load_conversion_manifest(manifest_path) if resume else {}
+
+    chunks = []
+    n_skipped = 0
+    for split, img_ids in split_ids.items():
+        pending_ids = []
+        pending_paths = []
+        for img_id in img_ids:
+            paths = get_conversion_paths(img_id, dir_path, voc_data_dir, split, coco_data_dir)
+            if voc_index is not None and voc_index.get(split) is not None:
+                entry = voc_index[split][img_id]
+                paths = (entry["annotation"], entry["image"]) + paths[2:]
+            if resume and is_converted(manifest, split, img_id, paths):
+                n_skipped += 1
+                continue
+            pending_ids.append(img_id)
+            pending_paths.append(paths)
+        for i in range(0, len(pending_ids), chunk_size):
+            chunks.append((split, pending_ids[i:i + chunk_size], pending_paths[i:i + chunk_size], label_map))
+    print('%d images already converted, converting the remaining %d' % (n_skipped, sum(len(c[1]) for c in chunks)))
+
+    n_converted = 0
+    methods = {}
+    with open(manifest_path, 'a' if resume else 'w') as manifest_file, \
+         ProcessPoolExecutor(max_workers = num_workers) as process_pool, \
+         ThreadPoolExecutor(max_workers = num_threads) as thread_pool:
+        parsing = {process_pool.submit(convert_annotation_chunk, chunk) for chunk in chunks}
+        copying = {}
+        while parsing or copying:
+            done, _ = wait(parsing | set(copying), return_when = FIRST_COMPLETED)
+            for future in done:
+                if future in parsing:
+                    parsing.remove(future)
+                    split, img_ids, paths, records = future.result()
+                    copying[thread_pool.submit(link_or_copy_chunk, paths, image_mode)] = (split, img_ids, records)
+                else:
+                    split, img_ids, records = copying.pop(future)
+                    for method in future.result():
+                        methods[method] = methods.get(method, 0) + 1
+                    # an image is recorded once both its label file and its image are in place
+                    manifest_file.writelines(json.dumps({'split': split, 'id': img_id, 'source': record}) + '\n'
+                                             for img_id, record in zip(img_ids, records))
+                    manifest_file.flush()
+                    n_converted += len(img_ids)
+    return n_converted, n_skipped, methods
+
         
 def get_args_parse():
     parser = argparse.ArgumentParser(
@@ -173,27 +418,42 @@ def get_args_parse():
                         help = 'The file path of the numpy array that contains the image tracking.')
     parser.add_argument('--path_to_predefined_classes', type = str, 
                         help = 'The file path of the numpy array that contains the tile names and tile urls of the complete arrays.')
+    parser.add_argument('--split', action = 'store_true',
+                        help = 'Split the images of dir_path into the train, val and test sets of voc_data_folder first.')
+    parser.add_argument('--split_mode', type = str, default = "copy", choices = ["copy", "symlink", "hardlink", "index"],
+                        help = 'With --split, copy, symlink or hard link the files into the split folders, or only index their paths.')
+    parser.add_argument('--num_workers', type = int, default = None,
+                        help = 'The number of processes parsing the xmls, the cpu count by default.')
+    parser.add_argument('--num_threads', type = int, default = 8,
+                        help = 'The number of threads linking or copying the images.')
+    parser.add_argument('--chunk_size', type = int, default = 256,
+                        help = 'The number of images handed to a worker at a time.')
+    parser.add_argument('--image_mode', type = str, default = "hardlink", choices = ["hardlink", "reflink", "copy"],
+                        help = 'Hard link, reflink or copy the images; links fall back to a copy across filesystems.')
+    parser.add_argument('--no_resume', dest = 'resume', action = 'store_false',
+                        help = 'Convert every image, instead of skipping those in the conversion manifest.')
     args = parser.parse_args()
     return args
 
 def main(args):
     #make directories to store split data
-    make_split_dirs(args.voc_data_folder)    
+    voc_folder = os.path.join(args.dir_path, args.voc_data_folder)
+    make_split_dirs(voc_folder)    
     make_split_dirs(args.coco_data_folder)
     
     img_paths, img_ids = get_image_paths_in_dir(args.dir_path, args.save_dir)
-    #split_train_val_test(img_paths, 1, args.voc_data_folder, args.save_dir, train_percent = 0.8, val_percent = 0.1)
+    if args.split:
+        split_train_val_test(img_paths, 1, voc_folder, args.save_dir, train_percent = 0.8, val_percent = 0.1, mode = args.split_mode)
     label_map = dataset.get_label_map(args.save_dir, args.path_to_predefined_classes)
-    for img_id in read_list(os.path.join(args.save_dir,"train_img_ids.txt")):
-        convert_annotation(img_id, args.dir_path, args.voc_data_folder, "train", args.coco_data_folder, label_map)
-        copy_converted_images(img_id, args.dir_path, args.voc_data_folder, "train", args.coco_data_folder)
-                            
-    for img_id in read_list(os.path.join(args.save_dir,"val_img_ids.txt")):
-        convert_annotation(img_id, args.dir_path, args.voc_data_folder,"val", args.coco_data_folder, label_map)
-        copy_converted_images(img_id, args.dir_path, args.voc_data_folder, "val", args.coco_data_folder)
-    for img_id in read_list(os.path.join(args.save_dir,"test_img_ids.txt")):
-        convert_annotation(img_id, args.dir_path, args.voc_data_folder, "test", args.coco_data_folder, label_map)
-        copy_converted_images(img_id, args.dir_path, args.voc_data_folder, "test", args.coco_data_folder)
+    # write_list ends each id with a space
+    split_ids = {split: [img_id.strip() for img_id in read_list(os.path.join(args.save_dir, split + "_img_ids.txt")) if img_id.strip()]
+                 for split in ["train", "val", "test"]}
+    n_converted, n_skipped, methods = convert_voc_to_yolo(args.dir_path, args.voc_data_folder, args.coco_data_folder, split_ids, label_map,
+                                                          num_workers = args.num_workers, num_threads = args.num_threads,
+                                                          chunk_size = args.chunk_size, image_mode = args.image_mode,
+                                                          resume = args.resume,
+                                                          voc_index = {split: load_split_index(voc_folder, split) for split in split_ids})
+    print('%d images converted (%s), %d skipped' % (n_converted, ", ".join("%d %s" % (n, m) for m, n in methods.items()), n_skipped))
 
 
 if __name__ == '__main__':
@@ -23,6 +23,10 @@ import os
 
 import random 
 import math
+import hashlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 import torch
 import torchvision
@@ -32,7 +36,7 @@ from sklearn.model_selection import KFold, train_test_split
 from PIL import Image
 import xml.etree.ElementTree as et
 
-#from transforms import get_transform
+from transforms import get_transform, get_tensor_transform, read_image_tensor
 
 def get_label_map(save_dir, path_to_predefined_classes):
     """
@@ -81,41 +85,103 @@ def make_list_of_image_ids(parent_dir, img_dir = "img", anno_dir = "xml"):
     f.writelines(img_id)
     f.close() #to change file access modes
     
-def split_train_val_test(parent_directory, complete_img_ids, train_val_percent = 0.8):
+def get_tile_name(img_id):
+    """
+    get the name of the tile a chip was cut from; chips are named <tile name>_<chip index>
+    """
+    return img_id.rsplit("_", 1)[0]
+
+def get_img_classes(anno_path, img_id):
+    """
+    get the (lower case) class names of the objects annotated in an image
+    """
+    root = et.parse(os.path.join(anno_path, img_id + ".xml")).getroot()
+    return [object.find('name').text.lower().strip() for object in root.iter('object')]
+
+def get_class_strata(img_classes):
+    """
+    Assign each image to the stratum of the rarest class it contains (by the number of images containing each class),
+    so images with rare classes are split in proportion; images without objects form their own stratum
+    :param img_classes: a list with the class names of each image
+    :return: array of the stratum of each image
+    """
+    class_counts = {}
+    for classes in img_classes:
+        for c in set(classes):
+            class_counts[c] = class_counts.get(c, 0) + 1
+    strata = [min(set(classes), key = lambda c: (class_counts[c], c)) if len(classes) > 0 else "" for classes in img_classes]
+    return np.array(strata, dtype = np.str_)
+
+def split_train_val_mask(num_imgs, train_val_percent, groups = None, strata = None, seed = 42):
+    """
+    Boolean mask of the images assigned to the train/val set.
+    Without groups or strata, the images are sampled with random.sample(range(num_imgs)) seeded with seed, as they
+    always have been, so existing splits are unchanged.
+    With groups (e.g. the tile of each chip), whole groups are assigned to one set, in a random order, until the
+    train/val set holds at least ceil(n * train_val_percent) images. With strata (e.g. from get_class_strata) this is
+    done separately in each stratum; a group takes the stratum of its image with the rarest stratum.
+    """
+    if groups is None and strata is None:
+        random.seed(seed)
+        train_val_img_idx = random.sample(range(num_imgs), math.ceil(num_imgs * train_val_percent))
+        mask = np.zeros(num_imgs, dtype = bool)
+        mask[train_val_img_idx] = True
+        return mask
+
+    if groups is None:
+        groups = np.arange(num_imgs)
+    _, group_idx, group_sizes = np.unique(np.asarray(groups), return_inverse = True, return_counts = True)
+    group_idx = group_idx.reshape(-1)
+    if strata is None:
+        group_strata = np.zeros(len(group_sizes), dtype = np.int64)
+    else:
+        _, strata_idx, strata_counts = np.unique(np.asarray(strata), return_inverse = True, return_counts = True)
+        strata_idx = strata_idx.reshape(-1)
+        # the image of each group whose stratum is the rarest
+        order = np.lexsort((strata_counts[strata_idx], group_idx))
+        first = np.concatenate([[0], np.flatnonzero(np.diff(group_idx[order])) + 1])
+        group_strata = strata_idx[order[first]]
+
+    rng = np.random.RandomState(seed)
+    group_in_train_val = np.zeros(len(group_sizes), dtype = bool)
+    for stratum in np.unique(group_strata):
+        stratum_groups = rng.permutation(np.flatnonzero(group_strata == stratum))
+        sizes = group_sizes[stratum_groups]
+        target = math.ceil(sizes.sum() * train_val_percent)
+        # take groups until the train/val set of the stratum is full
+        group_in_train_val[stratum_groups[(np.cumsum(sizes) - sizes) < target]] = True
+    return group_in_train_val[group_idx]
+
+def split_train_val_test(parent_directory, complete_img_ids, train_val_percent = 0.8, split_by = "random", anno_dir = None):
     """
     get a text file of the ids for the train/val and test sets
     Percentage of trainval:test and train: validation 
+    split_by: "random" (the seed 42 split), "tile" (chips from the same tile stay in the same set),
+    "class" (stratified by the rarest class in each image, needs anno_dir) or "tile_class" (both)
     """
+    assert split_by in {"random", "tile", "class", "tile_class"}
     #get list of all of the img_ids
     with open(os.path.join(parent_directory, complete_img_ids)) as f:
         img_ids_list = f.read().splitlines()
 
-    #Calculate numbers of images that should be in the train/val and test sets
-    num_imgs = len(img_ids_list)  
-    num_train_val_imgs = math.ceil(num_imgs * train_val_percent)  
-    num_test_imgs = num_imgs - num_train_val_imgs
+    groups = None
+    strata = None
+    if split_by in {"tile", "tile_class"}:
+        groups = [get_tile_name(img_id) for img_id in img_ids_list]
+    if split_by in {"class", "tile_class"}:
+        assert anno_dir is not None, "stratifying by class needs the annotation directory"
+        anno_path = os.path.join(parent_directory, anno_dir)
+        strata = get_class_strata([get_img_classes(anno_path, img_id) for img_id in img_ids_list])
 
     #randomly sample images to be in the train/val and test sets
-    random.seed(42)
-    train_val_img_idx = random.sample(range(num_imgs), num_train_val_imgs)  
-    test_img_idx = list(set(list(range(num_imgs))) - set(train_val_img_idx))
-
-    #get a list of the values for the randomly sampled values
-    train_val_img_id_list = []
-    test_img_id_list = [] 
-
-    for index, value in enumerate(img_ids_list):
-        if index in train_val_img_idx:  
-            train_val_img_id_list.append(''.join(map(str,[value,"\n"])))
-
-        if index in test_img_idx:  
-            test_img_id_list.append(''.join(map(str,[value,"\n"])))
+    train_val_mask = split_train_val_mask(len(img_ids_list), train_val_percent, groups = groups, strata = strata)
+    img_ids = np.array(img_ids_list, dtype = object)
 
     #Write .txt files.
     with open(os.path.join(parent_directory,"train_val_img_id.txt"), 'w') as train_val_img_id:
-        train_val_img_id.writelines(train_val_img_id_list) #write lines
+        train_val_img_id.writelines(''.join(map(str,[value,"\n"])) for value in img_ids[train_val_mask]) #write lines
     with open(os.path.join(parent_directory,"test_img_id.txt"), 'w')  as test_img_id:
-        test_img_id.writelines(test_img_id_list)
+        test_img_id.writelines(''.join(map(str,[value,"\n"])) for value in img_ids[~train_val_mask])
         
 def parse_annotation(anno_path, img_id, label_map, keep_difficult = True, bbox_remove = 20):
     """
@@ -178,10 +244,12 @@ def create_data_lists(parent_dir, img_dir, anno_dir, path_to_predefined_classes,
     # Find IDs of images for subset
     with open(os.path.join(parent_dir, subset_img_ids)) as f:
         ids = f.read().splitlines()
-        
+    # the label map is the same for every image, load it once
+    label_map = get_label_map(parent_dir, path_to_predefined_classes)
+
     for id in ids:
         # Parse annotation's XML file
-        objects = parse_annotation(anno_path, id, get_label_map(parent_dir, path_to_predefined_classes),
+        objects = parse_annotation(anno_path, id, label_map,
                                     keep_difficult = True, bbox_remove = bbox_remove)
         if len(objects['boxes']) == 0:
             no_obs += 1
@@ -204,10 +272,626 @@ def create_data_lists(parent_dir, img_dir, anno_dir, path_to_predefined_classes,
             j.write(chunk)
             
     return len(subset_images), n_objects, os.path.abspath(parent_dir)
-        
+
+class JsonListWriter(object):
+    """
+    Write a json list to file one element at a time, so the whole list is never encoded as a single string
+    """
+    def __init__(self, path):
+        self.path = path
+        self.n_items = 0
+    def __enter__(self):
+        self.f = open(self.path, 'w')
+        self.f.write('[')
+        return self
+    def extend(self, items):
+        for item in items:
+            if self.n_items > 0:
+                self.f.write(', ')
+            self.f.write(json.dumps(item))
+            self.n_items += 1
+    def __exit__(self, *exc):
+        self.f.write(']')
+        self.f.close()
+
+def get_shard_path(shard_dir, shard_idx):
+    """
+    get the path of the json file holding the parsed annotations of a shard
+    """
+    return os.path.join(shard_dir, "shard_" + str(shard_idx).zfill(5) + ".json")
+
+def get_shard_settings(img_path, label_map, bbox_remove):
+    """
+    the settings the annotations of a shard are parsed with, saved in the shard so a run with other settings parses it again
+    """
+    return {'img_path': img_path, 'label_map': label_map, 'bbox_remove': bbox_remove}
+
+def parse_annotation_shard(shard_args):
+    """
+    Parse the annotations for a shard of image ids and save them to the shard file.
+    The shard is written to a temporary file and renamed once complete, so a partially written shard is never read on resume.
+    argument: a tuple of (shard path, image ids, image path, annotation path, label map, bbox_remove)
+    returns: the shard path, the number of images with objects and the number of objects
+    """
+    shard_path, ids, img_path, anno_path, label_map, bbox_remove = shard_args
+    shard = {'ids': ids, 'settings': get_shard_settings(img_path, label_map, bbox_remove),
+             'images': [], 'objects': [], 'empty_images': []}
+    n_objects = 0
+    for id in ids:
+        objects = parse_annotation(anno_path, id, label_map, keep_difficult = True, bbox_remove = bbox_remove)
+        if len(objects['boxes']) == 0:
+            shard['empty_images'].append(os.path.join(img_path, id + '.jpg'))
+            continue
+        n_objects += len(objects['boxes'])
+        shard['objects'].append(objects)
+        shard['images'].append(os.path.join(img_path, id + '.jpg'))
+
+    tmp_path = shard_path + ".tmp"
+    with open(tmp_path, 'w') as j:
+        json.dump(shard, j)
+    os.replace(tmp_path, shard_path)
+    return shard_path, len(shard['images']), n_objects
+
+def load_completed_shard(shard_path, ids, settings):
+    """
+    Load a shard written by a previous run, returns None if it is missing or was built from a different list of ids
+    or with different settings (see get_shard_settings)
+    """
+    if not os.path.isfile(shard_path):
+        return None
+    with open(shard_path, 'r') as j:
+        shard = json.load(j)
+    if shard['ids'] != ids or shard.get('settings') != settings:
+        return None
+    return shard
+
+def create_data_lists_parallel(parent_dir, img_dir, anno_dir, path_to_predefined_classes, subset_img_ids, subset_name,
+                               bbox_remove = 20, num_workers = None, shard_size = 1000, resume = True):
+    """
+    Create the same files as create_data_lists, parsing the annotations in a process pool.
+    The image ids are split into shards of shard_size ids, each shard is parsed by a worker and saved to
+    <parent_dir>/<subset_name>_shards as soon as it completes. With resume, shards completed by an earlier
+    (interrupted) run over the same ids, with the same image directory, label map and bbox_remove, are reused
+    instead of being parsed again.
+    """
+    img_path = os.path.join(parent_dir, img_dir)
+    anno_path = os.path.join(parent_dir, anno_dir)
+    shard_dir = os.path.join(parent_dir, subset_name + "_shards")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    with open(os.path.join(parent_dir, subset_img_ids)) as f:
+        ids = f.read().splitlines()
+    label_map = get_label_map(parent_dir, path_to_predefined_classes)
+    settings = get_shard_settings(img_path, label_map, bbox_remove)
+
+    shard_ids = [ids[i:i + shard_size] for i in range(0, len(ids), shard_size)]
+    shard_paths = [get_shard_path(shard_dir, i) for i in range(len(shard_ids))]
+
+    pending = []
+    for shard_path, ids_ in zip(shard_paths, shard_ids):
+        if resume and load_completed_shard(shard_path, ids_, settings) is not None:
+            continue
+        pending.append((shard_path, ids_, img_path, anno_path, label_map, bbox_remove))
+    print('%d of %d shards already parsed, parsing the remaining %d' % (
+          len(shard_ids) - len(pending), len(shard_ids), len(pending)))
+
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            for shard_path, n_shard_images, n_shard_objects in executor.map(parse_annotation_shard, pending):
+                print('parsed %s: %d images, %d objects' % (os.path.basename(shard_path), n_shard_images, n_shard_objects))
+
+    # Merge the shards, in order, into the subset files, holding one shard in memory at a time
+    n_images = 0
+    n_objects = 0
+    with JsonListWriter(os.path.join(parent_dir, subset_name + '_images.json')) as images_writer, \
+         JsonListWriter(os.path.join(parent_dir, subset_name + '_objects.json')) as objects_writer, \
+         JsonListWriter(os.path.join(parent_dir, 'empty_images.json')) as empty_writer:
+        for shard_path, ids_ in zip(shard_paths, shard_ids):
+            shard = load_completed_shard(shard_path, ids_, settings)
+            assert shard is not None, "missing shard " + shard_path
+            images_writer.extend(shard['images'])
+            objects_writer.extend(shard['objects'])
+            empty_writer.extend(shard['empty_images'])
+            n_images += len(shard['images'])
+            n_objects += sum(len(objects['boxes']) for objects in shard['objects'])
+    return n_images, n_objects, os.path.abspath(parent_dir)
+
+class AnnotationStore(object):
+    """
+    Columnar store of the objects in a subset, replacing the list of per-image dictionaries in <subset>_objects.json.
+    The objects of every image are concatenated into flat arrays, and the objects of image i are the rows
+    offsets[i]:offsets[i + 1]. Each array is saved as a .npy file in the store directory, so it can be memory-mapped
+    and shared by every process reading the store instead of being parsed into python objects by each of them.
+
+    boxes (float32[M, 4]), labels (int64[M]), difficulties (uint8[M]), offsets (int64[N + 1]), images (str[N])
+    """
+    arrays = ('images', 'boxes', 'labels', 'difficulties', 'offsets')
+
+    def __init__(self, images, boxes, labels, difficulties, offsets, index = None):
+        self.images = images
+        self.boxes = boxes
+        self.labels = labels
+        self.difficulties = difficulties
+        self.offsets = offsets
+        # optional indices into the store, so a subset is a view of the arrays instead of a copy
+        self.index = index
+
+    @classmethod
+    def from_data_lists(cls, images, objects):
+        """
+        Build the store from the lists of images and objects made by create_data_lists
+        """
+        assert len(images) == len(objects)
+        n_objects = [len(o['boxes']) for o in objects]
+        offsets = np.zeros(len(objects) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(n_objects)
+        boxes = np.zeros((offsets[-1], 4), dtype = np.float32)
+        labels = np.zeros(offsets[-1], dtype = np.int64)
+        difficulties = np.zeros(offsets[-1], dtype = np.uint8)
+        for i, o in enumerate(objects):
+            if n_objects[i] == 0:
+                continue
+            boxes[offsets[i]:offsets[i + 1]] = o['boxes']
+            labels[offsets[i]:offsets[i + 1]] = o['labels']
+            difficulties[offsets[i]:offsets[i + 1]] = o['difficulties']
+        return cls(np.array(images, dtype = np.str_), boxes, labels, difficulties, offsets)
+
+    @classmethod
+    def load(cls, store_dir, mmap = True):
+        """
+        Load a store saved by save, memory-mapping the arrays (read only) unless mmap is False
+        """
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(store_dir, name + '.npy'), mmap_mode = mmap_mode) for name in cls.arrays])
+
+    def save(self, store_dir):
+        """
+        Save the arrays of the store (the whole store, even if this is a subset view) as .npy files.
+        Each file is written to a temporary file and renamed, so a store that is memory-mapped by another
+        process (or by this one, when patching) is replaced rather than truncated under it.
+        """
+        os.makedirs(store_dir, exist_ok = True)
+        for name in self.arrays:
+            path = os.path.join(store_dir, name + '.npy')
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, getattr(self, name))
+            os.replace(path + '.tmp', path)
+
+    def patch(self, remove_images, images, objects):
+        """
+        Make a new store without the objects of remove_images and with images/objects (lists as made by
+        create_data_lists): the images already in the store are replaced in place, the others are appended.
+        The rows are gathered with array indexing.
+        """
+        assert self.index is None, "patch the whole store, not a subset view"
+        added = AnnotationStore.from_data_lists(images, objects)
+        keep = ~np.isin(self.images, np.array(list(remove_images), dtype = np.str_))
+        # the index in added of each image of the store, -1 if it is not replaced
+        order = np.argsort(added.images)
+        position = np.searchsorted(added.images[order], self.images)
+        position = np.minimum(position, max(len(added) - 1, 0))
+        replaced = np.full(len(self), -1, dtype = np.int64)
+        if len(added) > 0:
+            match = added.images[order][position] == self.images
+            replaced[match] = order[position[match]]
+        kept = np.flatnonzero(keep)
+        appended = np.setdiff1d(np.arange(len(added)), replaced[kept])
+        # the images of the new store, as indices into the rows of self then added
+        images = np.concatenate([np.where(replaced[kept] >= 0, len(self) + replaced[kept], kept), len(self) + appended])
+        starts = np.concatenate([self.offsets[:-1], added.offsets[:-1] + len(self.boxes)])[images]
+        counts = np.concatenate([np.diff(self.offsets), np.diff(added.offsets)])[images]
+        offsets = np.zeros(len(images) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(counts)
+        rows = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return AnnotationStore(np.concatenate([self.images, added.images]).astype(np.str_)[images],
+                               np.concatenate([self.boxes, added.boxes])[rows],
+                               np.concatenate([self.labels, added.labels])[rows],
+                               np.concatenate([self.difficulties, added.difficulties])[rows],
+                               offsets)
+
+    def subset(self, indices):
+        """
+        A view of the store holding the images at indices; the arrays are shared, not copied
+        """
+        indices = np.asarray(indices, dtype = np.int64)
+        if self.index is not None:
+            indices = self.index[indices]
+        return AnnotationStore(self.images, self.boxes, self.labels, self.difficulties, self.offsets, index = indices)
+
+    def _store_idx(self, idx):
+        return idx if self.index is None else self.index[idx]
+
+    def get_image(self, idx):
+        return str(self.images[self._store_idx(idx)])
+
+    def get_images(self):
+        """
+        The image paths of the store (or the subset), as an array of strings
+        """
+        return self.images if self.index is None else self.images[self.index]
+
+    def num_objects(self, idx):
+        i = self._store_idx(idx)
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.index is None else len(self.index)
+
+    def __getitem__(self, idx):
+        """
+        The objects in image idx, in the same dictionary format as an element of <subset>_objects.json,
+        with slices of the (memory-mapped) arrays in place of lists
+        """
+        i = self._store_idx(idx)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {'boxes': self.boxes[start:end],
+                'labels': self.labels[start:end],
+                'difficulties': self.difficulties[start:end]}
+
+def get_store_dir(parent_dir, subset_name):
+    """
+    get the directory of the annotation store of a subset
+    """
+    return os.path.join(parent_dir, subset_name + '_store')
+
+def create_annotation_store(parent_dir, subset_name):
+    """
+    Convert the <subset_name>_images.json and <subset_name>_objects.json lists into an annotation store,
+    saved to <parent_dir>/<subset_name>_store
+    returns: the number of images and objects in the store
+    """
+    with open(os.path.join(parent_dir, subset_name + '_images.json'), 'r') as j:
+        images = json.load(j)
+    with open(os.path.join(parent_dir, subset_name + '_objects.json'), 'r') as j:
+        objects = json.load(j)
+    store = AnnotationStore.from_data_lists(images, objects)
+    store.save(get_store_dir(parent_dir, subset_name))
+    return len(store), len(store.labels)
+
+# Incremental parsing
+def get_manifest_path(parent_dir):
+    return os.path.join(parent_dir, "annotation_manifest.json")
+
+def hash_file(path):
+    """
+    sha1 of the contents of a file
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def get_file_record(path):
+    """
+    the manifest record of an annotation file: its modification time, size and content hash
+    """
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': hash_file(path)}
+
+def build_annotation_manifest(anno_path, ids):
+    """
+    Record the state of the annotation files of ids, so a later run can tell which of them changed
+    """
+    return {id: get_file_record(os.path.join(anno_path, id + ".xml")) for id in ids}
+
+def save_annotation_manifest(parent_dir, manifest, img_ids = None):
+    """
+    img_ids: the text file (in parent_dir) of the image ids the manifest covers, None for every xml of the annotation directory
+    """
+    tmp_path = get_manifest_path(parent_dir) + ".tmp"
+    with open(tmp_path, 'w') as j:
+        json.dump({'img_ids': img_ids, 'files': manifest}, j)
+    os.replace(tmp_path, get_manifest_path(parent_dir))
+
+def load_annotation_manifest(parent_dir):
+    """
+    load the manifest saved by the last run, returns None if there is none
+    returns: {'img_ids': the id file it covers or None, 'files': {id: record}}
+    """
+    if not os.path.isfile(get_manifest_path(parent_dir)):
+        return None
+    with open(get_manifest_path(parent_dir), 'r') as j:
+        manifest = json.load(j)
+    if set(manifest) != {'img_ids', 'files'}:
+        # saved before the id file was recorded, it covers the whole annotation directory
+        manifest = {'img_ids': None, 'files': manifest}
+    return manifest
+
+def diff_annotation_manifest(anno_path, manifest, ids = None):
+    """
+    Compare the annotation files of ids (every xml in anno_path by default) against the manifest of the last run.
+    The content hash is only computed for files whose modification time or size changed, a file that was
+    touched but whose contents are unchanged is not reported as changed.
+    returns: the updated manifest, and the lists of added, changed and deleted ids
+    """
+    if ids is None:
+        ids = [os.path.splitext(f)[0] for f in os.listdir(anno_path) if f.endswith(".xml")]
+    # an id listed twice is compared once
+    ids = list(dict.fromkeys(ids))
+    new_manifest = {}
+    added = []
+    changed = []
+    for id in ids:
+        path = os.path.join(anno_path, id + ".xml")
+        if not os.path.isfile(path):
+            continue
+        record = manifest.get(id)
+        stat = os.stat(path)
+        if record is not None and record['mtime'] == stat.st_mtime and record['size'] == stat.st_size:
+            new_manifest[id] = record
+            continue
+        new_record = get_file_record(path)
+        new_manifest[id] = new_record
+        if record is None:
+            added.append(id)
+        elif record['sha1'] != new_record['sha1']:
+            changed.append(id)
+    deleted = [id for id in manifest if id not in new_manifest]
+    return new_manifest, added, changed, deleted
+
+def assign_split(img_id, train_val_percent, salt = ""):
+    """
+    Assign a new image to the train/val or the test set from a hash of its id, so the assignment
+    does not depend on the order or the number of images added in a run.
+    salt: prefixed to the id, for an assignment independent of this one (e.g. the train/val split of split_method)
+    """
+    fraction = int(hashlib.sha1((salt + img_id).encode()).hexdigest()[:8], 16) / 16 ** 8
+    return "train" if fraction < train_val_percent else "test"
+
+def get_stable_val_mask(images, val_size):
+    """
+    Mask of the validation images, from a hash of their ids (see assign_split), so each image keeps its
+    train/val assignment when images are added to or removed from the list
+    """
+    ids = [os.path.splitext(os.path.basename(str(image)))[0] for image in images]
+    return np.array([assign_split(id, 1 - val_size, salt = "val") == "test" for id in ids], dtype = bool)
+
+def read_img_ids(parent_dir, subset_img_ids):
+    with open(os.path.join(parent_dir, subset_img_ids)) as f:
+        return f.read().splitlines()
+
+def write_img_ids(parent_dir, subset_img_ids, ids):
+    with open(os.path.join(parent_dir, subset_img_ids), 'w') as f:
+        f.writelines(''.join(map(str,[id,"\n"])) for id in ids)
+
+def update_data_lists(parent_dir, img_dir, anno_dir, path_to_predefined_classes, train_val_percent = 0.8,
+                      bbox_remove = 20, num_workers = 0, split_by = "random", complete_img_ids = None):
+    """
+    Update the split id files, the json lists and the annotation stores (if they exist) made by an earlier run,
+    only parsing the annotation files that were added or changed since the manifest was saved.
+    Unchanged images keep their train/val or test assignment and their place in the lists; changed images are
+    replaced in place, deleted images are removed and added images are appended.
+    Added images are assigned with assign_split; with split_by "tile" or "tile_class", an image whose tile already
+    has images joins their set, and the images of a new tile are assigned together from the tile name.
+    complete_img_ids: the text file of the image ids to consider, by default the one the manifest was built from
+    (every xml in anno_dir if it was built without one)
+    returns: the number of test images and objects, the number of train/val images and objects
+    """
+    img_path = os.path.join(parent_dir, img_dir)
+    anno_path = os.path.join(parent_dir, anno_dir)
+    manifest = load_annotation_manifest(parent_dir)
+    assert manifest is not None, "no annotation manifest in " + parent_dir + ", run a full parse first"
+
+    img_ids = complete_img_ids or manifest['img_ids']
+    ids = read_img_ids(parent_dir, img_ids) if img_ids is not None else None
+    manifest, added, changed, deleted = diff_annotation_manifest(anno_path, manifest['files'], ids)
+    print('%d added, %d changed and %d deleted annotation files' % (len(added), len(changed), len(deleted)))
+
+    label_map = get_label_map(parent_dir, path_to_predefined_classes)
+    reparse = added + changed
+    parse = partial(parse_annotation, anno_path, label_map = label_map, keep_difficult = True, bbox_remove = bbox_remove)
+    if num_workers > 0 and len(reparse) > 0:
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            parsed = dict(zip(reparse, executor.map(parse, reparse, chunksize = 64)))
+    else:
+        parsed = {id: parse(id) for id in reparse}
+
+    # the images parsed again or deleted leave the lists, unless they are parsed into the same list again
+    remove_images = set(os.path.join(img_path, id + '.jpg') for id in reparse + deleted)
+    split_img_ids = {"train": "train_val_img_id.txt", "test": "test_img_id.txt"}
+    split_ids = {split: read_img_ids(parent_dir, subset_img_ids) for split, subset_img_ids in split_img_ids.items()}
+    current_split = {id: split for split, ids in split_ids.items() for id in ids}
+    deleted_ids = set(deleted)
+    for split in split_ids:
+        split_ids[split] = [id for id in split_ids[split] if id not in deleted_ids]
+    by_tile = split_by in {"tile", "tile_class"}
+    tile_split = {get_tile_name(id): split for id, split in current_split.items() if id not in deleted_ids} if by_tile else {}
+    # a changed image in neither split file is assigned as an added one
+    for id in added + changed:
+        if id not in current_split:
+            if by_tile:
+                tile = get_tile_name(id)
+                split = tile_split.setdefault(tile, assign_split(tile, train_val_percent))
+            else:
+                split = assign_split(id, train_val_percent)
+            current_split[id] = split
+            split_ids[split].append(id)
+
+    empty_images = []
+    counts = {}
+    for split, subset_img_ids in split_img_ids.items():
+        write_img_ids(parent_dir, subset_img_ids, split_ids[split])
+        new_images = []
+        new_objects = []
+        for id in reparse:
+            if current_split.get(id) != split:
+                continue
+            if len(parsed[id]['boxes']) == 0:
+                empty_images.append(os.path.join(img_path, id + '.jpg'))
+                continue
+            new_images.append(os.path.join(img_path, id + '.jpg'))
+            new_objects.append(parsed[id])
+
+        with open(os.path.join(parent_dir, split + '_images.json'), 'r') as j:
+            images = json.load(j)
+        with open(os.path.join(parent_dir, split + '_objects.json'), 'r') as j:
+            objects = json.load(j)
+        # replace the images parsed again in place, so the order of the unchanged images is kept. The train/val split
+        # of split_method only stays the same with stable_val: train_test_split reshuffles when the length changes
+        parsed_objects = dict(zip(new_images, new_objects))
+        kept_images = []
+        kept_objects = []
+        for image, image_objects in zip(images, objects):
+            if image in parsed_objects:
+                kept_images.append(image)
+                kept_objects.append(parsed_objects.pop(image))
+            elif image not in remove_images:
+                kept_images.append(image)
+                kept_objects.append(image_objects)
+        images = kept_images + list(parsed_objects)
+        objects = kept_objects + list(parsed_objects.values())
+        with JsonListWriter(os.path.join(parent_dir, split + '_images.json')) as writer:
+            writer.extend(images)
+        with JsonListWriter(os.path.join(parent_dir, split + '_objects.json')) as writer:
+            writer.extend(objects)
+        counts[split] = (len(images), sum(len(o['boxes']) for o in objects))
+
+        store_dir = get_store_dir(parent_dir, split)
+        if os.path.isdir(store_dir):
+            store = AnnotationStore.load(store_dir).patch(remove_images - set(new_images), new_images, new_objects)
+            store.save(store_dir)
+
+    empty_images_path = os.path.join(parent_dir, 'empty_images.json')
+    if os.path.isfile(empty_images_path):
+        with open(empty_images_path, 'r') as j:
+            empty_images = [image for image in json.load(j) if image not in remove_images] + empty_images
+    with JsonListWriter(empty_images_path) as writer:
+        writer.extend(empty_images)
+
+    save_annotation_manifest(parent_dir, manifest, img_ids)
+    return counts["test"] + counts["train"]
+
+def get_image_sizes_path(parent_dir):
+    return os.path.join(parent_dir, "image_sizes.json")
+
+def read_image_size(img_path):
+    """
+    (height, width) of an image, read from its header; PIL does not decode the pixels until they are used
+    """
+    with Image.open(img_path) as image:
+        width, height = image.size
+    return [height, width]
+
+def get_image_sizes(parent_dir, images, num_workers = 8):
+    """
+    The size index of the images, kept in image_sizes.json ({image path: [height, width]}).
+    Only the images that are not in the index yet have their header read (by a pool of threads), and are added to it.
+    :return: the (height, width) of each image, an int array of dimensions (n_images, 2)
+    """
+    sizes = {}
+    if os.path.isfile(get_image_sizes_path(parent_dir)):
+        with open(get_image_sizes_path(parent_dir), 'r') as j:
+            sizes = json.load(j)
+    missing = [str(image) for image in images if str(image) not in sizes]
+    if len(missing) > 0:
+        with ThreadPoolExecutor(max_workers = num_workers) as executor:
+            sizes.update(zip(missing, executor.map(read_image_size, missing)))
+        tmp_path = get_image_sizes_path(parent_dir) + ".tmp"
+        with open(tmp_path, 'w') as j:
+            json.dump(sizes, j)
+        os.replace(tmp_path, get_image_sizes_path(parent_dir))
+    return np.array([sizes[str(image)] for image in images], dtype = np.int64).reshape(-1, 2)
+
+class DecodedImageCache(object):
+    """
+    Cache of decoded RGB images, saved as a uint8 array of shape (n_cached, height, width, 3) in pixels.npy.
+    The array is memory-mapped (read only) by every process using the cache, so the DataLoader workers share
+    one copy of the pixels in the page cache and index into it instead of decoding the JPEGs every epoch.
+    Only the first images that fit in max_bytes are cached (and only images of size image_size);
+    the others are decoded on the fly.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.slots = np.load(os.path.join(cache_dir, "slots.npy")) # the row of each image in pixels, -1 if not cached
+        self.nbytes = int((self.slots >= 0).sum()) * int(np.prod(np.load(os.path.join(cache_dir, "shape.npy"))))
+        self.pixels = None
+
+    def __getstate__(self):
+        # do not pickle the memory map (when the workers are spawned), each process opens its own
+        state = self.__dict__.copy()
+        state['pixels'] = None
+        return state
+
+    def get(self, idx):
+        """
+        the decoded image idx, an (height, width, 3) uint8 array, or None if it is not cached
+        """
+        slot = self.slots[idx]
+        if slot < 0:
+            return None
+        if self.pixels is None:
+            self.pixels = np.load(os.path.join(self.cache_dir, "pixels.npy"), mmap_mode = 'r')
+        return self.pixels[slot]
+
+    @staticmethod
+    def build(cache_dir, images, max_bytes, image_size = (512, 512), num_workers = 8):
+        """
+        Decode the images into a new cache, unless cache_dir already holds a cache of the same images and size cap
+        :param images: the image paths, in the order of the dataset
+        :param max_bytes: the maximum size of the cached pixels
+        :param image_size: (height, width) of the cached images
+        """
+        images = np.array(images, dtype = np.str_)
+        height, width = image_size
+        shape = np.array([height, width, 3], dtype = np.int64)
+        n_cached = int(min(len(images), max_bytes // int(np.prod(shape))))
+        if os.path.isdir(cache_dir):
+            try:
+                same_images = np.array_equal(np.load(os.path.join(cache_dir, "images.npy")), images)
+                same_shape = np.array_equal(np.load(os.path.join(cache_dir, "shape.npy")), shape)
+                same_cap = int(np.load(os.path.join(cache_dir, "n_cached.npy"))) == n_cached
+                if same_images and same_shape and same_cap:
+                    return DecodedImageCache(cache_dir)
+            except (OSError, ValueError):
+                pass
+        os.makedirs(cache_dir, exist_ok = True)
+        if os.path.isfile(os.path.join(cache_dir, "images.npy")):
+            # invalidate the old cache first, images.npy is written last
+            os.remove(os.path.join(cache_dir, "images.npy"))
+
+        pixels = np.lib.format.open_memmap(os.path.join(cache_dir, "pixels.npy.tmp"), mode = 'w+',
+                                           dtype = np.uint8, shape = (n_cached, height, width, 3))
+        def decode(i):
+            # close the file once decoded, each thread would otherwise keep one open per image
+            with Image.open(images[i], mode = 'r') as source:
+                image = source.convert('RGB')
+            if image.size != (width, height):
+                return False
+            pixels[i] = np.asarray(image)
+            return True
+
+        print("Decoding %d of %d images into %s" % (n_cached, len(images), cache_dir))
+        # PIL releases the GIL while decoding, so threads decode in parallel
+        with ThreadPoolExecutor(max_workers = num_workers) as executor:
+            decoded = np.fromiter(executor.map(decode, range(n_cached)), dtype = bool, count = n_cached)
+        pixels.flush()
+        del pixels
+
+        slots = np.full(len(images), -1, dtype = np.int64)
+        slots[:n_cached][decoded] = np.flatnonzero(decoded)
+        os.replace(os.path.join(cache_dir, "pixels.npy.tmp"), os.path.join(cache_dir, "pixels.npy"))
+        for name, array in [("slots", slots), ("shape", shape), ("n_cached", np.array(n_cached)), ("images", images)]:
+            np.save(os.path.join(cache_dir, name + ".npy"), array)
+        return DecodedImageCache(cache_dir)
+
 # DataLoader
-def split_method(parent_directory, method, val_size = 0.1):
-    "Load the training data, and split out validation data"
+def split_method(parent_directory, method, val_size = 0.1, annotation_format = "json", stable_val = False):
+    """
+    Load the training data, and split out validation data
+    stable_val: pick the validation images from a hash of their ids (get_stable_val_mask) instead of with
+    train_test_split, so they stay the same when parse.py --incremental adds or deletes images
+    """
+    if method == "simple_val" and annotation_format == "store":
+        # the same split as the json lists, taken as views of the memory-mapped stores
+        train_store = AnnotationStore.load(get_store_dir(parent_directory, "train"))
+        if stable_val:
+            val_mask = get_stable_val_mask(train_store.get_images(), val_size)
+            train_idx, val_idx = np.flatnonzero(~val_mask), np.flatnonzero(val_mask)
+        else:
+            train_idx, val_idx = train_test_split(np.arange(len(train_store)), test_size = val_size, random_state=42)
+        train_objects = train_store.subset(train_idx)
+        val_objects = train_store.subset(val_idx)
+        test_objects = AnnotationStore.load(get_store_dir(parent_directory, "test"))
+        return (train_objects.get_images(), train_objects, val_objects.get_images(), val_objects,
+                test_objects.get_images(), test_objects)
     if method == "simple_val":
         
         for split in ["train", "test"]:
@@ -216,7 +900,13 @@ def split_method(parent_directory, method, val_size = 0.1):
             with open(os.path.join(parent_directory, split + '_objects.json'), 'r') as j:
                 objects = json.load(j)
                 assert len(images) == len(objects) 
-            if split == "train":
+            if split == "train" and stable_val:
+                val_mask = get_stable_val_mask(images, val_size)
+                train_images = [image for image, val in zip(images, val_mask) if not val]
+                train_objects = [objects_ for objects_, val in zip(objects, val_mask) if not val]
+                val_images = [image for image, val in zip(images, val_mask) if val]
+                val_objects = [objects_ for objects_, val in zip(objects, val_mask) if val]
+            elif split == "train":
                 train_images, val_images, train_objects, val_objects = train_test_split(images, objects, test_size = val_size, random_state=42)
             else:
                 test_images = images
@@ -229,7 +919,7 @@ class pascal_voc_dataset(torch.utils.data.Dataset):
     A PyTorch Dataset class to be used in a PyTorch DataLoader to create batches.
     """
 
-    def __init__(self, images, objects, train):
+    def __init__(self, images, objects, train, image_cache = None, backend = "pil", augment = True, image_sizes = None):
         """
         The __init__ function is run once when instantiating the Dataset object. 
         We initialize the directory containing the images, the annotations file, 
@@ -238,10 +928,25 @@ class pascal_voc_dataset(torch.utils.data.Dataset):
         :param data_folder: folder where data files are stored
         :param split: split, one of 'train' or 'test'
         :param keep_difficult: keep or discard objects that are considered difficult to detect?
+        :param objects: the list of object dictionaries, or an AnnotationStore (see split_method)
+        :param image_cache: an optional DecodedImageCache of the images, in the same order
+        :param backend: "pil" to transform PIL images (get_transform), or "tensor" to decode straight to a
+                        uint8 tensor and transform tensors (get_tensor_transform)
+        :param augment: apply the training augmentation per sample; False when it is applied to the
+                        collated batch instead (transforms.BatchAugmentation)
+        :param image_sizes: an optional (n_images, 2) array of the (height, width) of the images (see get_image_sizes),
+                            so get_height_and_width does not open the images
         """        
         self.images = images #the image lists
         
-        self.objects = objects #the object lists
+        self.objects = objects #the object lists, or an AnnotationStore
+        
+        self.image_cache = image_cache
+        self.image_sizes = image_sizes
+        
+        assert backend in {"pil", "tensor"}
+        self.backend = backend
+        self.augment = augment
         
         if train: # Read in train data 
             self.split = "train"
@@ -264,18 +969,33 @@ class pascal_voc_dataset(torch.utils.data.Dataset):
         """
         # Load image
         #print("print image name from loader", self.images[idx])
-        image = Image.open(self.images[idx], mode='r')
-        image = image.convert('RGB')
+        image = self.load_image(idx)
         image_id = torch.tensor([idx])
         
         # Read objects in this image (bounding boxes, labels, difficulties)
-        objects = self.objects[idx]
-        boxes = torch.FloatTensor(objects['boxes'])  # (n_objects, 4)
-        labels = torch.LongTensor(objects['labels'])  # (n_objects)
-        difficulties = torch.ByteTensor(objects['difficulties'])  # (n_objects)
+        boxes, labels, difficulties = self.load_objects(idx)
                     
         #Apply transformations
-        image, boxes, labels, difficulties = get_transform(image, boxes, labels, difficulties, split = self.split)
+        split = self.split if self.augment else "test"
+        if self.backend == "tensor":
+            image, boxes, labels, difficulties = get_tensor_transform(image, boxes, labels, difficulties, split = split)
+        else:
+            image, boxes, labels, difficulties = get_transform(image, boxes, labels, difficulties, split = split)
+        target = self.make_target(image_id, boxes, labels)
+
+        return image, target
+        #return image, boxes, labels, difficulties
+    def load_objects(self, idx):
+        """
+        The bounding boxes, labels and difficulties of image idx, as tensors
+        """
+        objects = self.objects[idx]
+        # copy, since the objects may be read only slices of a memory-mapped AnnotationStore
+        boxes = torch.tensor(objects['boxes'], dtype=torch.float32).reshape(-1, 4)  # (n_objects, 4)
+        labels = torch.tensor(objects['labels'], dtype=torch.int64)  # (n_objects)
+        difficulties = torch.tensor(objects['difficulties'], dtype=torch.uint8)  # (n_objects)
+        return boxes, labels, difficulties
+    def make_target(self, image_id, boxes, labels):
         num_objs = boxes.size()[0]
         area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
         # suppose all instances are not crowd
@@ -288,9 +1008,53 @@ class pascal_voc_dataset(torch.utils.data.Dataset):
         target["area"] = area
         target["image_id"] = image_id
         target["iscrowd"] = iscrowd
-
-        return image, target
-        #return image, boxes, labels, difficulties
+        return target
+    def get_annotations(self, idx):
+        """
+        The target of image idx, as returned by __getitem__ without augmentation, without loading the image
+        """
+        boxes, labels, difficulties = self.load_objects(idx)
+        return self.make_target(torch.tensor([idx]), boxes, labels)
+    def get_height_and_width(self, idx):
+        """
+        The height and width of image idx, from the size index, or else read from the image header (the pixels are not decoded)
+        """
+        if self.image_sizes is not None:
+            height, width = self.image_sizes[idx]
+            return int(height), int(width)
+        height, width = read_image_size(self.images[idx])
+        return height, width
+    def get_num_objects(self, idx):
+        return len(self.objects[idx]['labels'])
+    def annotations_fingerprint(self):
+        """
+        A hash of the images and objects of the dataset, which changes whenever the annotations change
+        """
+        sha1 = hashlib.sha1()
+        if isinstance(self.objects, AnnotationStore):
+            store = self.objects
+            index = store.index if store.index is not None else np.arange(len(store))
+            for array in [index, store.offsets, store.boxes, store.labels]:
+                sha1.update(np.ascontiguousarray(array).tobytes())
+            sha1.update(json.dumps([str(image) for image in self.images]).encode())
+        else:
+            sha1.update(json.dumps([[str(image) for image in self.images],
+                                    [[o['boxes'], o['labels']] for o in self.objects]]).encode())
+        return sha1.hexdigest()
+    def load_image(self, idx):
+        """
+        Load image idx, from the image cache if it holds it, as a PIL image or a uint8 (3, H, W) tensor depending on the backend
+        """
+        cached = self.image_cache.get(idx) if self.image_cache is not None else None
+        if self.backend == "tensor":
+            if cached is not None:
+                # copy, the cache is a read only memory map
+                return torch.from_numpy(np.array(cached)).permute(2, 0, 1)
+            return read_image_tensor(str(self.images[idx]))
+        if cached is not None:
+            return Image.fromarray(np.array(cached))
+        image = Image.open(self.images[idx], mode='r')
+        return image.convert('RGB')
     def __len__(self):
         """
         The __len__ function returns the number of samples in our dataset.
@@ -0,0 +1,202 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+#python dataset_statistics.py --parent_directory ~/work/Test --split train --num_workers 16
+#python dataset_statistics.py --parent_directory /shared_space/natech/Test --split train --num_workers 16 --statistics_path /shared_space/natech/Test/train_statistics.json
+
+# the edges of the box histograms; the boxes out of range are counted in the first or last bin
+BOX_SIZE_EDGES = 2 ** np.arange(0, 11.25, 0.25) # 1 to 2048 pixels
+ASPECT_RATIO_EDGES = 2 ** np.arange(-4, 4.25, 0.25) # width / height, 1/16 to 16
+
+class RunningMoments(object):
+    """
+    The count, mean and sum of squared deviations (m2) of each channel, updated a batch of values at a time with
+    Welford's algorithm. Moments computed separately merge into those of all the values (Chan et al.), so each worker
+    can summarize its share of the images.
+    """
+    def __init__(self, num_channels = 3):
+        self.count = 0
+        self.mean = np.zeros(num_channels)
+        self.m2 = np.zeros(num_channels)
+
+    def update(self, values):
+        """
+        :param values: an array of dimensions (n, num_channels)
+        """
+        values = np.asarray(values, dtype = np.float64)
+        batch = RunningMoments(values.shape[1])
+        batch.count = values.shape[0]
+        if batch.count > 0:
+            batch.mean = values.mean(axis = 0)
+            batch.m2 = np.square(values - batch.mean).sum(axis = 0)
+        return self.merge(batch)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + np.square(delta) * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+class DatasetStatistics(object):
+    """
+    Per-channel pixel moments (in [0, 1], as the images are given to the model) and histograms of the image sizes,
+    the box sizes and aspect ratios and the number of boxes of each class. Every field is a running sum or a
+    histogram with fixed bins, so the memory does not grow with the dataset and the statistics of separate
+    workers merge.
+    """
+    def __init__(self, num_classes):
+        self.num_images = 0
+        self.pixels = RunningMoments(3)
+        self.image_sizes = {}
+        self.class_counts = np.zeros(num_classes, dtype = np.int64)
+        self.box_histograms = {"width": np.zeros(len(BOX_SIZE_EDGES) - 1, dtype = np.int64),
+                               "height": np.zeros(len(BOX_SIZE_EDGES) - 1, dtype = np.int64),
+                               "size": np.zeros(len(BOX_SIZE_EDGES) - 1, dtype = np.int64),
+                               "aspect_ratio": np.zeros(len(ASPECT_RATIO_EDGES) - 1, dtype = np.int64)}
+
+    def update_image(self, image):
+        """
+        :param image: a uint8 array of dimensions (H, W, 3)
+        """
+        self.num_images += 1
+        height, width = image.shape[:2]
+        size = "%dx%d" % (height, width)
+        self.image_sizes[size] = self.image_sizes.get(size, 0) + 1
+        self.pixels.update(image.reshape(-1, 3) / 255.)
+
+    def update_boxes(self, boxes, labels):
+        """
+        :param boxes: bounding boxes in boundary coordinates, of dimensions (n_objects, 4)
+        :param labels: their encoded labels
+        """
+        boxes = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+        self.class_counts += np.bincount(np.asarray(labels, dtype = np.int64), minlength = len(self.class_counts))
+        width = boxes[:, 2] - boxes[:, 0]
+        height = boxes[:, 3] - boxes[:, 1]
+        valid = (width > 0) & (height > 0)
+        width, height = width[valid], height[valid]
+        for name, values, edges in [("width", width, BOX_SIZE_EDGES), ("height", height, BOX_SIZE_EDGES),
+                                    ("size", np.sqrt(width * height), BOX_SIZE_EDGES),
+                                    ("aspect_ratio", width / height, ASPECT_RATIO_EDGES)]:
+            self.box_histograms[name] += np.histogram(np.clip(values, edges[0], edges[-1]), bins = edges)[0]
+
+    def merge(self, other):
+        self.num_images += other.num_images
+        self.pixels.merge(other.pixels)
+        for size, count in other.image_sizes.items():
+            self.image_sizes[size] = self.image_sizes.get(size, 0) + count
+        self.class_counts += other.class_counts
+        for name in self.box_histograms:
+            self.box_histograms[name] += other.box_histograms[name]
+        return self
+
+    def to_dict(self, label_map):
+        class_names = {v: k for k, v in label_map.items()}
+        edges = {"width": BOX_SIZE_EDGES, "height": BOX_SIZE_EDGES, "size": BOX_SIZE_EDGES, "aspect_ratio": ASPECT_RATIO_EDGES}
+        return {"num_images": self.num_images,
+                "num_pixels": self.pixels.count,
+                "mean": self.pixels.mean.tolist(),
+                "std": self.pixels.std.tolist(),
+                "image_sizes": dict(sorted(self.image_sizes.items(), key = lambda item: -item[1])),
+                "num_boxes": int(self.class_counts.sum()),
+                "class_counts": {class_names.get(label, str(label)): int(count) for label, count in enumerate(self.class_counts)},
+                "box_histograms": {name: {"edges": edges[name].tolist(), "counts": counts.tolist()}
+                                   for name, counts in self.box_histograms.items()}}
+
+def compute_statistics_chunk(chunk_args):
+    """
+    The statistics of a chunk of images, in a worker process
+    argument: a tuple of (image paths, their objects, number of classes)
+    """
+    images, objects, num_classes = chunk_args
+    statistics = DatasetStatistics(num_classes)
+    for image_path, image_objects in zip(images, objects):
+        with Image.open(image_path) as image:
+            statistics.update_image(np.asarray(image.convert('RGB')))
+        statistics.update_boxes(image_objects['boxes'], image_objects['labels'])
+    return statistics
+
+def compute_dataset_statistics(images, objects, label_map, num_workers = 0, chunk_size = 64):
+    """
+    The statistics of images and their objects (as saved by parse.py), each chunk of chunk_size images summarized
+    by one of num_workers processes (0 reads them in this process); only the partial statistics are sent back and merged
+    :return: a DatasetStatistics
+    """
+    num_classes = max(label_map.values()) + 1
+    chunks = [(images[i:i + chunk_size], objects[i:i + chunk_size], num_classes) for i in range(0, len(images), chunk_size)]
+    statistics = DatasetStatistics(num_classes)
+    if num_workers == 0:
+        for chunk in chunks:
+            statistics.merge(compute_statistics_chunk(chunk))
+        return statistics
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        for future in as_completed([executor.submit(compute_statistics_chunk, chunk) for chunk in chunks]):
+            statistics.merge(future.result())
+    return statistics
+
+def get_statistics_path(parent_dir, split):
+    return os.path.join(parent_dir, split + "_statistics.json")
+
+def save_dataset_statistics(statistics, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as j:
+        json.dump(statistics, j, indent = 1)
+    os.replace(tmp_path, path)
+
+def load_dataset_statistics(path):
+    with open(path, 'r') as j:
+        return json.load(j)
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(
+        description='This script computes the per-channel mean / std of the images of a split and histograms of their boxes')
+    parser.add_argument('--parent_directory', type = str, default = None,
+                        help = 'path to parent directory, holding the <split>_images.json, <split>_objects.json and label_map.json made by parse.py')
+    parser.add_argument('--split', type = str, default = "train", choices = ["train", "test"],
+                        help = 'The split to compute the statistics of')
+    parser.add_argument('--statistics_path', type = str, default = None,
+                        help = 'The json file the statistics are saved to, <parent_directory>/<split>_statistics.json by default')
+    parser.add_argument('--num_workers', type = int, default = 0,
+                        help = 'The number of processes reading the images, 0 reads them in this process')
+    parser.add_argument('--chunk_size', type = int, default = 64,
+                        help = 'The number of images handed to a worker at a time')
+    args = parser.parse_args()
+    return args
+
+def main(args):
+    with open(os.path.join(args.parent_directory, args.split + '_images.json'), 'r') as j:
+        images = json.load(j)
+    with open(os.path.join(args.parent_directory, args.split + '_objects.json'), 'r') as j:
+        objects = json.load(j)
+    with open(os.path.join(args.parent_directory, 'label_map.json'), 'r') as j:
+        label_map = json.load(j)
+    assert len(images) == len(objects)
+
+    statistics = compute_dataset_statistics(images, objects, label_map, num_workers = args.num_workers, chunk_size = args.chunk_size)
+    statistics = statistics.to_dict(label_map)
+    statistics_path = args.statistics_path or get_statistics_path(args.parent_directory, args.split)
+    save_dataset_statistics(statistics, statistics_path)
+    print('%d images, %d boxes: mean %s, std %s, saved to %s' % (statistics["num_images"], statistics["num_boxes"],
+                                                                  ["%.4f" % v for v in statistics["mean"]],
+                                                                  ["%.4f" % v for v in statistics["std"]], statistics_path))
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    main(args)
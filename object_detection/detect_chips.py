@@ -0,0 +1,279 @@
+import os
+import json
+import glob
+import argparse
+
+import torch
+import torchvision.transforms.functional as FT
+
+import detection.model
+from transforms import read_image_tensor
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#python detect_chips.py --checkpoint ~/work/Test/lr0.005_lrdecay0.1_epoch25checkpoint_frcnn_best.pth.tar --img_directory ~/work/Test/chips --output_path ~/work/Test/chip_detections.jsonl --batch_size 16 --num_workers 8 --device cpu
+
+def iter_image_paths(img_dir, extensions = ('.jpg', '.jpeg', '.png')):
+    """
+    Lazily yield the paths of the images in a directory, without listing the whole directory into memory
+    """
+    with os.scandir(img_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                yield entry.path
+
+def path_to_id(img_path):
+    return os.path.splitext(os.path.basename(img_path))[0]
+
+class ChipDataset(torch.utils.data.IterableDataset):
+    """
+    Iterate over the images in a directory, decoding each one to a float tensor.
+    Each DataLoader worker scans the directory and decodes every num_workers-th image, so the paths are
+    never collected in the main process, and the images already in skip_ids are not decoded.
+    """
+    def __init__(self, img_dir, skip_ids = None):
+        self.img_dir = img_dir
+        self.skip_ids = skip_ids if skip_ids is not None else set()
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for i, img_path in enumerate(iter_image_paths(self.img_dir)):
+            if i % num_workers != worker_id:
+                continue
+            img_id = path_to_id(img_path)
+            if img_id in self.skip_ids:
+                continue
+            yield img_id, FT.convert_image_dtype(read_image_tensor(img_path), torch.float)
+
+def collate_chips(batch):
+    img_ids, images = zip(*batch)
+    return list(img_ids), list(images)
+
+class JsonLinesWriter(object):
+    """
+    Write one json line per image, {"image_id", "boxes", "labels", "scores"}, appending to the file
+    """
+    def __init__(self, output_path):
+        self.output_path = output_path
+
+    def processed_ids(self):
+        """
+        the ids already in the file; a line cut by an interrupted run is removed
+        """
+        ids = set()
+        if not os.path.isfile(self.output_path):
+            return ids
+        with open(self.output_path, 'rb+') as f:
+            complete = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                ids.add(json.loads(line)['image_id'])
+                complete += len(line)
+            f.truncate(complete)
+        return ids
+
+    def open(self, resume):
+        self.f = open(self.output_path, 'a' if resume else 'w')
+
+    def write(self, img_ids, outputs):
+        for img_id, output in zip(img_ids, outputs):
+            self.f.write(json.dumps({'image_id': img_id, 'boxes': output['boxes'].tolist(),
+                                     'labels': output['labels'].tolist(), 'scores': output['scores'].tolist()}) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class CocoResultsWriter(object):
+    """
+    Write the detections as a COCO results json list ({"image_id", "category_id", "bbox" [x, y, w, h], "score"}),
+    one detection at a time. Since the list has no entry for an image without detections, the ids of the images
+    written are kept in <output_path>.ids, each batch with the size of the results file after it, so an
+    interrupted run is resumed from the end of the last complete batch.
+    """
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.ids_path = output_path + '.ids'
+        self.offset = 0
+
+    def processed_ids(self):
+        """
+        the ids of the complete batches; a line of the ids file cut by an interrupted run is removed,
+        so the next batch is not appended to it
+        """
+        ids = set()
+        if not (os.path.isfile(self.output_path) and os.path.isfile(self.ids_path)):
+            return ids
+        with open(self.ids_path, 'rb+') as f:
+            complete = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                batch = json.loads(line)
+                ids.update(batch['ids'])
+                self.offset = batch['offset']
+                complete += len(line)
+            f.truncate(complete)
+        return ids
+
+    def open(self, resume):
+        if not resume or self.offset == 0:
+            self.offset = 0
+            self.f = open(self.output_path, 'w')
+            self.f.write('[')
+            open(self.ids_path, 'w').close()
+        else:
+            self.f = open(self.output_path, 'r+')
+            self.f.truncate(self.offset)
+            self.f.seek(self.offset)
+        self.n_written = self.offset > 1
+        self.ids_file = open(self.ids_path, 'a')
+
+    def write(self, img_ids, outputs):
+        for img_id, output in zip(img_ids, outputs):
+            boxes = output['boxes'].clone()
+            boxes[:, 2:] -= boxes[:, :2]
+            for box, label, score in zip(boxes.tolist(), output['labels'].tolist(), output['scores'].tolist()):
+                if self.n_written:
+                    self.f.write(', ')
+                self.f.write(json.dumps({'image_id': img_id, 'category_id': label, 'bbox': box, 'score': score}))
+                self.n_written = True
+        self.f.flush()
+        self.ids_file.write(json.dumps({'ids': img_ids, 'offset': self.f.tell()}) + '\n')
+        self.ids_file.flush()
+
+    def close(self):
+        self.f.write(']')
+        self.f.close()
+        self.ids_file.close()
+
+class ParquetWriter(object):
+    """
+    Write one row per image (image_id, boxes, labels, scores) to parquet part files in the output directory.
+    Rows are buffered and each part file is written whole (to a temporary file, then renamed), so a part file
+    is either complete or missing after an interrupted run.
+    """
+    def __init__(self, output_path, rows_per_part = 100000):
+        assert pyarrow is not None, "writing parquet needs pyarrow"
+        self.output_path = output_path
+        self.rows_per_part = rows_per_part
+
+    def part_paths(self):
+        return sorted(glob.glob(os.path.join(self.output_path, 'part-*.parquet')))
+
+    def processed_ids(self):
+        ids = set()
+        for part_path in self.part_paths():
+            ids.update(pyarrow.parquet.read_table(part_path, columns=['image_id']).column('image_id').to_pylist())
+        return ids
+
+    def open(self, resume):
+        os.makedirs(self.output_path, exist_ok = True)
+        if not resume:
+            for part_path in self.part_paths():
+                os.remove(part_path)
+        self.n_parts = len(self.part_paths())
+        self.rows = {'image_id': [], 'boxes': [], 'labels': [], 'scores': []}
+
+    def write(self, img_ids, outputs):
+        for img_id, output in zip(img_ids, outputs):
+            self.rows['image_id'].append(img_id)
+            self.rows['boxes'].append(output['boxes'].tolist())
+            self.rows['labels'].append(output['labels'].tolist())
+            self.rows['scores'].append(output['scores'].tolist())
+        if len(self.rows['image_id']) >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows['image_id']) == 0:
+            return
+        part_path = os.path.join(self.output_path, 'part-' + str(self.n_parts).zfill(5) + '.parquet')
+        pyarrow.parquet.write_table(pyarrow.table(self.rows), part_path + '.tmp')
+        os.replace(part_path + '.tmp', part_path)
+        self.n_parts += 1
+        self.rows = {k: [] for k in self.rows}
+
+    def close(self):
+        self.flush()
+
+def get_writer(output_format, output_path):
+    if output_format == 'jsonl':
+        return JsonLinesWriter(output_path)
+    elif output_format == 'coco':
+        return CocoResultsWriter(output_path)
+    elif output_format == 'parquet':
+        return ParquetWriter(output_path)
+    else:
+        raise ValueError('Not valid output format')
+
+@torch.no_grad()
+def detect_chips(model, data_loader, writer, device, min_score = 0.05, print_freq = 100):
+    """
+    Run the model over the batches of the data loader and write the detections of each batch as it completes
+    :return: the number of images processed
+    """
+    n_images = 0
+    for i, (img_ids, images) in enumerate(data_loader):
+        images = [image.to(device) for image in images]
+        outputs = model(images)
+        outputs = [{k: v[o['scores'] >= min_score].cpu() for k, v in o.items()} for o in outputs]
+        writer.write(img_ids, outputs)
+        n_images += len(img_ids)
+        if i % print_freq == 0:
+            print('%d images processed' % n_images)
+    return n_images
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(
+        description='This script runs a trained checkpoint over a directory of chips')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='path to the checkpoint saved by model_train.py')
+    parser.add_argument('--img_directory', type=str, default=None,
+                        help='path to the directory holding the chips')
+    parser.add_argument('--output_path', type=str, default='chip_detections.jsonl',
+                        help='The output file (jsonl, coco) or directory (parquet)')
+    parser.add_argument('--output_format', type=str, default='jsonl', choices=['jsonl', 'coco', 'parquet'],
+                        help='jsonl (one line per image), coco (a COCO results list) or parquet (one row per image)')
+    parser.add_argument('--no_resume', dest='resume', action='store_false',
+                        help='Start over, instead of skipping the images already in the output')
+    parser.add_argument('--min_score', type=float, default=0.05,
+                        help='The minimum score of the detections written')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='The batch size.')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='The number of data loader workers decoding images')
+    parser.add_argument('--device', type=str, default=None,
+                        help='The device to be used')
+    args = parser.parse_args()
+    return args
+
+def main(args):
+    if args.device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(args.device)
+    model = detection.model.load_checkpoint_model(args.checkpoint, device)
+
+    writer = get_writer(args.output_format, args.output_path)
+    skip_ids = writer.processed_ids() if args.resume else set()
+    print('Skipping %d images that were already processed' % len(skip_ids))
+
+    chip_dataset = ChipDataset(args.img_directory, skip_ids)
+    data_loader = torch.utils.data.DataLoader(chip_dataset, batch_size = args.batch_size, num_workers = args.num_workers,
+                                              collate_fn = collate_chips, pin_memory = device.type == 'cuda')
+    writer.open(args.resume)
+    try:
+        n_images = detect_chips(model, data_loader, writer, device, args.min_score)
+    finally:
+        writer.close()
+    print('%d images processed, detections saved to %s' % (n_images, args.output_path))
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    main(args)
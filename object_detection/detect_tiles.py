@@ -0,0 +1,191 @@
+import os
+import json
+import argparse
+
+import torch
+import torchvision
+import torchvision.transforms.functional as FT
+from PIL import Image
+
+import detection.model
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
+#python detect_tiles.py --checkpoint ~/work/Test/lr0.005_lrdecay0.1_epoch25checkpoint_frcnn_best.pth.tar --tile_paths ~/work/tiles/*.tif --output_path ~/work/Test/tile_detections.jsonl --device cpu
+
+Image.MAX_IMAGE_PIXELS = None # the tiles are much larger than PIL's decompression bomb limit
+
+class TileReader(object):
+    """
+    Read windows of a large tile as uint8 tensors of dimensions (3, h, w).
+    Tiles (GeoTIFF, or any image GDAL reads) are read a window at a time with rasterio, so the memory does not grow
+    with the size of the tile. PIL cannot decode part of a jpg or png, so without rasterio the whole tile is only
+    decoded when asked to with decode_whole_tile.
+    """
+    def __init__(self, tile_path, decode_whole_tile=False):
+        self.tile_path = tile_path
+        self.dataset = None
+        self.image = None
+        if rasterio is not None:
+            self.dataset = rasterio.open(tile_path)
+            self.height, self.width = self.dataset.height, self.dataset.width
+            # grayscale tiles are repeated over the 3 channels, an alpha band is left out
+            self.indexes = [1, 2, 3] if self.dataset.count >= 3 else [1, 1, 1]
+        elif decode_whole_tile:
+            self.image = FT.pil_to_tensor(Image.open(tile_path).convert('RGB'))
+            self.height, self.width = self.image.shape[-2:]
+        else:
+            raise ImportError('reading %s a window at a time needs rasterio (pip install rasterio); '
+                              'pass --decode_whole_tile to decode the whole tile in memory with PIL instead' % tile_path)
+
+    def read_window(self, x0, y0, w, h):
+        if self.dataset is not None:
+            window = self.dataset.read(indexes=self.indexes, window=Window(x0, y0, w, h))
+            return torch.from_numpy(window)
+        return self.image[:, y0:y0 + h, x0:x0 + w]
+
+    def close(self):
+        if self.dataset is not None:
+            self.dataset.close()
+
+def get_window_origins(length, window_size, overlap):
+    """
+    get the start of each window along one side of the tile; the windows overlap by at least overlap pixels,
+    and the last window ends at the edge of the tile
+    """
+    if length <= window_size:
+        return [0]
+    stride = window_size - overlap
+    origins = list(range(0, length - window_size, stride))
+    origins.append(length - window_size)
+    return origins
+
+def drop_border_boxes(boxes, x0, y0, w, h, tile_width, tile_height, margin):
+    """
+    mask of the boxes (in window coordinates) that do not touch an edge of the window inside the tile;
+    those objects are cut by the window and are detected whole by the overlapping window.
+    An object larger than the overlap is cut by every window that holds it, so it is dropped from all of them:
+    the overlap has to be larger than the largest object
+    """
+    keep = torch.ones(boxes.size(0), dtype=torch.bool)
+    if x0 > 0:
+        keep &= boxes[:, 0] > margin
+    if y0 > 0:
+        keep &= boxes[:, 1] > margin
+    if x0 + w < tile_width:
+        keep &= boxes[:, 2] < w - margin
+    if y0 + h < tile_height:
+        keep &= boxes[:, 3] < h - margin
+    return keep
+
+@torch.no_grad()
+def detect_tile(model, tile_path, device, window_size=512, overlap=64, batch_size=8, iou_threshold=0.5,
+                min_score=0.05, border_margin=2, decode_whole_tile=False):
+    """
+    Run the detector over a large tile in overlapping windows, and yield the detections in tile coordinates.
+    Windows are run in batches, one row of windows at a time. After each row, duplicates across the window seams
+    are merged with class-aware NMS, and the detections that no later row of windows can overlap are yielded,
+    so only the detections of the last row of windows are held in memory, whatever the size of the tile.
+    The detections touching an edge of a window inside the tile are dropped (see drop_border_boxes), so objects
+    larger than the overlap, cut by every window, are not detected.
+    :yield: dictionaries of boxes (n, 4) [x0, y0, x1, y1], labels (n) and scores (n)
+    """
+    reader = TileReader(tile_path, decode_whole_tile)
+    x_origins = get_window_origins(reader.width, window_size, overlap)
+    y_origins = get_window_origins(reader.height, window_size, overlap)
+
+    pending = {'boxes': torch.zeros((0, 4)), 'labels': torch.zeros(0, dtype=torch.int64), 'scores': torch.zeros(0)}
+    for row, y0 in enumerate(y_origins):
+        for start in range(0, len(x_origins), batch_size):
+            windows = []
+            origins = []
+            for x0 in x_origins[start:start + batch_size]:
+                w = min(window_size, reader.width - x0)
+                h = min(window_size, reader.height - y0)
+                windows.append(FT.convert_image_dtype(reader.read_window(x0, y0, w, h), torch.float).to(device))
+                origins.append((x0, y0, w, h))
+            outputs = model(windows)
+            for (x0, y0_, w, h), output in zip(origins, outputs):
+                output = {k: v.cpu() for k, v in output.items()}
+                keep = (output['scores'] >= min_score) & drop_border_boxes(output['boxes'], x0, y0_, w, h,
+                                                                          reader.width, reader.height, border_margin)
+                boxes = output['boxes'][keep] + torch.tensor([x0, y0_, x0, y0_], dtype=torch.float32)
+                pending['boxes'] = torch.cat([pending['boxes'], boxes])
+                pending['labels'] = torch.cat([pending['labels'], output['labels'][keep]])
+                pending['scores'] = torch.cat([pending['scores'], output['scores'][keep]])
+
+        # merge the duplicates across window seams, within each class
+        keep = torchvision.ops.batched_nms(pending['boxes'], pending['scores'], pending['labels'], iou_threshold)
+        pending = {k: v[keep] for k, v in pending.items()}
+        # the detections above the next row of windows are final
+        next_y0 = y_origins[row + 1] if row + 1 < len(y_origins) else reader.height
+        done = pending['boxes'][:, 3] <= next_y0
+        if done.any():
+            yield {k: v[done] for k, v in pending.items()}
+        pending = {k: v[~done] for k, v in pending.items()}
+    reader.close()
+    if len(pending['scores']) > 0:
+        yield pending
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(
+        description='This script runs a trained Faster R-CNN over large tiles in overlapping windows')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='path to the checkpoint saved by model_train.py')
+    parser.add_argument('--tile_paths', type=str, nargs='+', default=None,
+                        help='paths to the tiles')
+    parser.add_argument('--output_path', type=str, default='tile_detections.jsonl',
+                        help='The json lines file the detections are written to, one detection per line')
+    parser.add_argument('--path_to_predefined_classes', type=str, default=None,
+                        help='The text file containing a list of the predefined classes, to write the class names')
+    parser.add_argument('--window_size', type=int, default=512,
+                        help='The size of the windows, the size of the training chips')
+    parser.add_argument('--overlap', type=int, default=64,
+                        help='The overlap between neighbouring windows, should be larger than the objects')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='The number of windows run through the model at a time')
+    parser.add_argument('--iou_threshold', type=float, default=0.5,
+                        help='IoU above which detections of the same class from overlapping windows are merged')
+    parser.add_argument('--min_score', type=float, default=0.05,
+                        help='The minimum score of the detections kept')
+    parser.add_argument('--decode_whole_tile', action='store_true',
+                        help='Without rasterio, decode each whole tile in memory with PIL instead of raising an error')
+    parser.add_argument('--device', type=str, default=None,
+                        help='The device to be used')
+    args = parser.parse_args()
+    return args
+
+def main(args):
+    if args.device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(args.device)
+    model = detection.model.load_checkpoint_model(args.checkpoint, device)
+
+    rev_label_map = None
+    if args.path_to_predefined_classes is not None:
+        with open(args.path_to_predefined_classes) as f:
+            rev_label_map = {v + 1: k for v, k in enumerate(f.read().splitlines())}
+
+    with open(args.output_path, 'w') as out_file:
+        for tile_path in args.tile_paths:
+            n_detections = 0
+            for detections in detect_tile(model, tile_path, device, args.window_size, args.overlap, args.batch_size,
+                                          args.iou_threshold, args.min_score,
+                                          decode_whole_tile=args.decode_whole_tile):
+                for box, label, score in zip(detections['boxes'].tolist(), detections['labels'].tolist(),
+                                             detections['scores'].tolist()):
+                    detection_dict = {'tile': os.path.basename(tile_path), 'bbox': box, 'label': label, 'score': score}
+                    if rev_label_map is not None:
+                        detection_dict['class'] = rev_label_map.get(label, 'background')
+                    out_file.write(json.dumps(detection_dict) + '\n')
+                n_detections += len(detections['scores'])
+            print('%s: %d detections' % (tile_path, n_detections))
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    main(args)
@@ -155,6 +155,152 @@ class CocoEvaluator(object):
         return coco_results
 
 
+class StreamingCocoEvaluator(object):
+    """
+    A CocoEvaluator (bbox only) whose memory does not grow with the number of images.
+    Each update matches the detections of its images to the ground truth as COCOeval.evaluateImg does, and adds
+    the matches to true / false positive histograms over score_bins score bins, for every category, area range,
+    max detections and IoU threshold. No results COCO object or per image eval dicts are kept, and the ground
+    truth is only read, so it is not copied.
+    accumulate() computes the precision and recall from the histograms: the detections in one score bin are
+    ranked together, so the AP matches COCOeval up to the score binning.
+    The histograms of the processes are summed, so each image must be evaluated by one process only: max_images
+    leaves out the images a DistributedSampler repeats at the end of the shards (see engine.get_unpadded_length).
+    """
+    def __init__(self, coco_gt, iou_types, score_bins=1000, max_images=None):
+        assert isinstance(iou_types, (list, tuple))
+        assert list(iou_types) == ["bbox"], "StreamingCocoEvaluator only evaluates bbox"
+        self.coco_gt = coco_gt
+        self.iou_types = iou_types
+        self.coco_eval = {"bbox": COCOeval(iouType="bbox")}
+        p = self.coco_eval["bbox"].params
+        p.catIds = sorted(coco_gt.getCatIds())
+        self.cat_index = {cat_id: k for k, cat_id in enumerate(p.catIds)}
+        self.score_bins = score_bins
+
+        K, A, M, T = len(p.catIds), len(p.areaRng), len(p.maxDets), len(p.iouThrs)
+        self.tp = np.zeros((K, A, M, T, score_bins), dtype=np.int64)
+        self.fp = np.zeros((K, A, M, T, score_bins), dtype=np.int64)
+        self.n_gt = np.zeros((K, A), dtype=np.int64)
+        # ids only, to skip images that are updated twice
+        self.img_ids = set()
+        # the number of images of this process to evaluate, the others are padding
+        self.max_images = max_images
+
+    def update(self, predictions):
+        for img_id, prediction in predictions.items():
+            if img_id in self.img_ids or (self.max_images is not None and len(self.img_ids) >= self.max_images):
+                continue
+            self.img_ids.add(img_id)
+            self.evaluate_image(img_id, prediction)
+
+    def evaluate_image(self, img_id, prediction):
+        p = self.coco_eval["bbox"].params
+        area_rng = np.array(p.areaRng, dtype=np.float64)
+        iou_thrs = np.minimum(p.iouThrs, 1 - 1e-10)
+        boxes = convert_to_xywh(prediction["boxes"]).numpy().astype(np.float64)
+        scores = prediction["scores"].numpy().astype(np.float64)
+        labels = prediction["labels"].numpy()
+        anns = self.coco_gt.imgToAnns[img_id]
+
+        for cat_id, k in self.cat_index.items():
+            gt = [ann for ann in anns if ann["category_id"] == cat_id]
+            dt = np.flatnonzero(labels == cat_id)
+            if len(gt) == 0 and len(dt) == 0:
+                continue
+            # highest score first, as in COCOeval
+            dt = dt[np.argsort(-scores[dt], kind="mergesort")][:p.maxDets[-1]]
+            G, D = len(gt), len(dt)
+
+            gt_area = np.array([g["area"] for g in gt], dtype=np.float64)
+            crowd = np.array([bool(g["iscrowd"]) for g in gt], dtype=bool)
+            gt_ignore = crowd[None] | (gt_area[None] < area_rng[:, 0:1]) | (gt_area[None] > area_rng[:, 1:2])  # (A, G)
+            self.n_gt[k] += np.count_nonzero(~gt_ignore, axis=1)
+            if D == 0:
+                continue
+
+            # greedy matching of COCOeval.evaluateImg, for all area ranges and IoU thresholds at once
+            found = np.zeros((len(area_rng), len(iou_thrs), D), dtype=bool)
+            found_ignored = np.zeros_like(found)
+            if G > 0:
+                ious = mask_util.iou(boxes[dt], np.array([g["bbox"] for g in gt], dtype=np.float64), crowd.astype(np.uint8))
+                free = np.ones((len(area_rng), len(iou_thrs), G), dtype=bool)
+                for d in range(D):
+                    cand = free & (ious[d][None, None] >= iou_thrs[None, :, None])
+                    # the gts that are not ignored are preferred
+                    regular = cand & ~gt_ignore[:, None]
+                    cand = np.where(regular.any(axis=-1, keepdims=True), regular, cand)
+                    # best IoU, the last of equal IoUs as in evaluateImg
+                    m = G - 1 - np.where(cand, ious[d], -np.inf)[..., ::-1].argmax(axis=-1)
+                    hit = cand.any(axis=-1)
+                    found[..., d] = hit
+                    found_ignored[..., d] = hit & np.take_along_axis(
+                        np.broadcast_to(gt_ignore[:, None], cand.shape), m[..., None], axis=-1)[..., 0]
+                    taken = np.zeros_like(cand)
+                    np.put_along_axis(taken, m[..., None], hit[..., None], axis=-1)
+                    free &= ~taken | crowd
+            # unmatched detections outside of the area range are ignored
+            dt_area = boxes[dt, 2] * boxes[dt, 3]
+            dt_outside = (dt_area[None] < area_rng[:, 0:1]) | (dt_area[None] > area_rng[:, 1:2])  # (A, D)
+            ignored = found_ignored | (~found & dt_outside[:, None])
+            tp = found & ~ignored
+            fp = ~found & ~ignored
+
+            bins = np.clip((scores[dt] * self.score_bins).astype(np.int64), 0, self.score_bins - 1)
+            for m, max_det in enumerate(p.maxDets):
+                n = min(D, max_det)
+                np.add.at(self.tp[k, :, m], (slice(None), slice(None), bins[:n]), tp[..., :n])
+                np.add.at(self.fp[k, :, m], (slice(None), slice(None), bins[:n]), fp[..., :n])
+
+    def synchronize_between_processes(self):
+        all_counts = detection.utils.all_gather((self.tp, self.fp, self.n_gt))
+        self.tp = sum(counts[0] for counts in all_counts)
+        self.fp = sum(counts[1] for counts in all_counts)
+        self.n_gt = sum(counts[2] for counts in all_counts)
+
+    def accumulate(self):
+        coco_eval = self.coco_eval["bbox"]
+        p = coco_eval.params
+        T, R, K, A, M = len(p.iouThrs), len(p.recThrs), len(p.catIds), len(p.areaRng), len(p.maxDets)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+        scores = -np.ones((T, R, K, A, M))
+
+        # cumulative counts, from the highest score bin down
+        tp_sum = np.cumsum(self.tp[..., ::-1], axis=-1).astype(float)
+        fp_sum = np.cumsum(self.fp[..., ::-1], axis=-1).astype(float)
+        bin_scores = (np.arange(self.score_bins)[::-1] + 0.5) / self.score_bins
+        for k in range(K):
+            for a in range(A):
+                npig = self.n_gt[k, a]
+                if npig == 0:
+                    continue
+                for m in range(M):
+                    rc = tp_sum[k, a, m] / npig  # (T, score_bins)
+                    pr = tp_sum[k, a, m] / (fp_sum[k, a, m] + tp_sum[k, a, m] + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1]
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        inds = np.searchsorted(rc[t], p.recThrs, side="left")
+                        valid = inds < self.score_bins
+                        precision[t, valid, k, a, m] = pr[t, inds[valid]]
+                        precision[t, ~valid, k, a, m] = 0
+                        scores[t, valid, k, a, m] = bin_scores[inds[valid]]
+                        scores[t, ~valid, k, a, m] = 0
+        coco_eval.eval = {
+            "params": p,
+            "counts": [T, R, K, A, M],
+            "precision": precision,
+            "recall": recall,
+            "scores": scores,
+        }
+
+    def summarize(self):
+        for iou_type, coco_eval in self.coco_eval.items():
+            print("IoU metric: {}".format(iou_type))
+            coco_eval.summarize()
+
+
 def convert_to_xywh(boxes):
     xmin, ymin, xmax, ymax = boxes.unbind(1)
     return torch.stack((xmin, ymin, xmax - xmin, ymax - ymin), dim=1)
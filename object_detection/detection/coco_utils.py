@@ -144,20 +144,39 @@ def _coco_remove_images_without_annotations(dataset, cat_list=None):
 
 
 def convert_to_coco_api(ds):
+    def samples():
+        for img_idx in range(len(ds)):
+            # find better way to get target
+            # targets = ds.get_annotations(img_idx)
+            img, targets = ds[img_idx]
+            yield img.shape[-2], img.shape[-1], targets
+    return _samples_to_coco_api(samples())
+
+
+def convert_annotations_to_coco_api(ds):
+    """
+    Same as convert_to_coco_api, for a dataset that can return its targets (get_annotations) and image sizes
+    (get_height_and_width) without loading and transforming every image
+    """
+    def samples():
+        for img_idx in range(len(ds)):
+            height, width = ds.get_height_and_width(img_idx)
+            yield height, width, ds.get_annotations(img_idx)
+    return _samples_to_coco_api(samples())
+
+
+def _samples_to_coco_api(samples):
     coco_ds = COCO()
     # annotation IDs need to start at 1, not 0, see torchvision issue #1530
     ann_id = 1
     dataset = {'images': [], 'categories': [], 'annotations': []}
     categories = set()
-    for img_idx in range(len(ds)):
-        # find better way to get target
-        # targets = ds.get_annotations(img_idx)
-        img, targets = ds[img_idx]
+    for height, width, targets in samples:
         image_id = targets["image_id"].item()
         img_dict = {}
         img_dict['id'] = image_id
-        img_dict['height'] = img.shape[-2]
-        img_dict['width'] = img.shape[-1]
+        img_dict['height'] = height
+        img_dict['width'] = width
         dataset['images'].append(img_dict)
         bboxes = targets["boxes"]
         bboxes[:, 2:] -= bboxes[:, :2]
@@ -195,7 +214,21 @@ def convert_to_coco_api(ds):
     return coco_ds
 
 
+def get_cached_coco_api(dataset):
+    """
+    The COCO ground truth of a dataset with get_annotations, built once and kept on the dataset.
+    It is rebuilt only when the dataset's annotations_fingerprint changes.
+    """
+    fingerprint = dataset.annotations_fingerprint()
+    cached = getattr(dataset, "coco_gt_cache", None)
+    if cached is None or cached[0] != fingerprint:
+        dataset.coco_gt_cache = (fingerprint, convert_annotations_to_coco_api(dataset))
+    return dataset.coco_gt_cache[1]
+
+
 def get_coco_api_from_dataset(dataset):
+    if hasattr(dataset, "get_annotations") and hasattr(dataset, "annotations_fingerprint"):
+        return get_cached_coco_api(dataset)
     for _ in range(10):
         if isinstance(dataset, torchvision.datasets.CocoDetection):
             break
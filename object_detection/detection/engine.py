@@ -1,27 +1,76 @@
 import math
 import sys
 import time
+import copy
+import queue
+import contextlib
 import torch
 
 import torchvision.models.detection.mask_rcnn
 
 from detection.coco_utils import get_coco_api_from_dataset
-from detection.coco_eval import CocoEvaluator
+from detection.coco_eval import CocoEvaluator, StreamingCocoEvaluator
 import detection.utils
 
-def train_one_epoch(model, optimizer, scheduler, data_loader, device, epoch, print_freq):
+def get_amp_dtype(amp, device):
+    """
+    The autocast dtype of an --amp option: none, bf16, fp16 or auto (bf16 on the cpu, fp16 on gpus)
+    """
+    if amp == "none":
+        return None
+    if amp == "auto":
+        return torch.bfloat16 if device.type == "cpu" else torch.float16
+    return {"bf16": torch.bfloat16, "fp16": torch.float16}[amp]
+
+def make_grad_scaler(amp_dtype, device):
+    """
+    A GradScaler for fp16 autocast. bf16 has the exponent range of fp32, so its gradients are not scaled
+    """
+    if amp_dtype != torch.float16:
+        return None
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device.type)
+    return torch.cuda.amp.GradScaler()
+
+def train_one_epoch(model, optimizer, scheduler, data_loader, device, epoch, print_freq, batch_transform=None,
+                    amp_dtype=None, scaler=None, accumulation_steps=1, profiler=None):
+    """
+    batch_transform: optional callable (images, targets) -> (images, targets) augmenting each collated batch,
+    e.g. transforms.BatchAugmentation
+    amp_dtype: run the forward pass under autocast to this dtype (torch.bfloat16 or torch.float16), None for fp32
+    scaler: a GradScaler (see make_grad_scaler) scaling the loss before backward, for fp16
+    accumulation_steps: step the optimizer once every accumulation_steps batches, on the gradient of their mean loss
+    profiler: an optional detection.utils.StepProfiler, timing the phases of each step
+    """
     model.train()
-    metric_logger = detection.utils.MetricLogger(delimiter="  ")
+    metric_logger = detection.utils.MetricLogger(delimiter="  ", profiler=profiler)
     metric_logger.add_meter('lr', detection.utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
+    if profiler is not None:
+        profiler.epoch = epoch
     
-    for images, targets in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    n_batches = len(data_loader)
+    optimizer.zero_grad()
+    for i, (images, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        if batch_transform is not None:
+            with metric_logger.phase("augment"):
+                images, targets = batch_transform(images, targets)
+        with metric_logger.phase("h2d"):
+            images = list(image.to(device) for image in images)
+            targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+
+        # the gradients of the batches of a step are summed, so each loss is divided by the number of batches
+        # in the step (the last step of the epoch may have fewer)
+        step_start = i - i % accumulation_steps
+        step_size = min(accumulation_steps, n_batches - step_start)
+        last_of_step = i - step_start == step_size - 1
+        # DistributedDataParallel only needs to all-reduce the gradients of the last batch of a step
+        no_sync = model.no_sync if hasattr(model, "no_sync") and not last_of_step else contextlib.nullcontext
         
-        loss_dict = model(images, targets)
+        with metric_logger.phase("forward"), no_sync(), torch.autocast(device_type=device.type, dtype=amp_dtype or torch.float32, enabled=amp_dtype is not None):
+            loss_dict = model(images, targets)
 
-        losses = sum(loss for loss in loss_dict.values())
+            losses = sum(loss for loss in loss_dict.values())
 
         # reduce losses over all GPUs for logging purposes
         loss_dict_reduced = detection.utils.reduce_dict(loss_dict)
@@ -34,10 +83,23 @@ def train_one_epoch(model, optimizer, scheduler, data_loader, device, epoch, pri
             print(loss_dict_reduced)
             sys.exit(1)
 
-        optimizer.zero_grad()
-        losses.backward()
-        optimizer.step()
-
+        losses = losses / step_size
+        with metric_logger.phase("backward"), no_sync():
+            if scaler is not None:
+                # the losses checked above are not scaled; the scaler skips the steps with inf / nan gradients
+                scaler.scale(losses).backward()
+            else:
+                losses.backward()
+        if last_of_step:
+            with metric_logger.phase("optimizer"):
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
+                optimizer.zero_grad()
+
+        # the losses logged are those of each batch, not divided
         metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         
@@ -56,12 +118,25 @@ def _get_iou_types(model):
     return iou_types
 
 
-@torch.no_grad()
-def evaluate(model, data_loader, device, print_freq = 100):
+def get_unpadded_length(sampler):
+    """
+    The number of samples of a DistributedSampler's shard that are not padding; the sampler repeats samples at
+    the end of the shards so they all have the same length. None for other samplers
+    """
+    if not isinstance(sampler, torch.utils.data.distributed.DistributedSampler) or sampler.drop_last:
+        return None
+    # the shard of the process holds the samples rank, rank + num_replicas, ... of the padded list
+    return len(range(sampler.rank, len(sampler.dataset), sampler.num_replicas))
 
+@torch.no_grad()
+def evaluate(model, data_loader, device, print_freq = 100, streaming = False, num_threads = 1):
+    """
+    streaming: use StreamingCocoEvaluator, whose memory does not grow with the size of the dataset
+    num_threads: the number of torch threads used while evaluating
+    """
     n_threads = torch.get_num_threads()
     # FIXME remove this and make paste_masks_in_image run on the GPU
-    torch.set_num_threads(1)
+    torch.set_num_threads(num_threads)
     cpu_device = torch.device("cpu")
     model.eval()
     metric_logger = detection.utils.MetricLogger(delimiter="  ")
@@ -69,7 +144,11 @@ def evaluate(model, data_loader, device, print_freq = 100):
 
     coco = get_coco_api_from_dataset(data_loader.dataset)
     iou_types = _get_iou_types(model)
-    coco_evaluator = CocoEvaluator(coco, iou_types)
+    if streaming:
+        # the histograms are summed over the processes, so the padding images must not be counted twice
+        coco_evaluator = StreamingCocoEvaluator(coco, iou_types, max_images = get_unpadded_length(data_loader.sampler))
+    else:
+        coco_evaluator = CocoEvaluator(coco, iou_types)
 
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
         images = list(img.to(device) for img in images)
@@ -98,3 +177,74 @@ def evaluate(model, data_loader, device, print_freq = 100):
     coco_evaluator.summarize()
     torch.set_num_threads(n_threads)
     return coco_evaluator
+
+
+def _evaluation_worker(model, dataset, loader_kwargs, device, num_threads, print_freq, streaming, tasks, results):
+    """
+    The loop of the AsyncEvaluator process: evaluate each (epoch, state_dict) snapshot until None is received
+    """
+    device = torch.device(device)
+    model.to(device)
+    data_loader = torch.utils.data.DataLoader(dataset, **loader_kwargs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, state_dict = task
+        model.load_state_dict(state_dict)
+        del state_dict
+        coco_evaluator = evaluate(model, data_loader, device, print_freq = print_freq, streaming = streaming,
+                                  num_threads = num_threads)
+        stats = {iou_type: coco_eval.stats.tolist() for iou_type, coco_eval in coco_evaluator.coco_eval.items()}
+        results.put((epoch, stats))
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluate snapshots of the model in a separate process, while the training process goes on with the next epoch.
+    submit() copies the weights to the cpu and queues them; at most one snapshot waits in the queue, so submit
+    blocks when the evaluation falls more than an epoch behind. poll() returns the (epoch, stats) of the
+    evaluations finished so far, stats being the COCO summary of each iou type.
+    """
+    def __init__(self, model, dataset, batch_size, num_workers = 0, device = "cpu", num_threads = 1,
+                 print_freq = 100, streaming = False):
+        model = getattr(model, "module", model)
+        context = torch.multiprocessing.get_context("spawn")
+        self.tasks = context.Queue(maxsize = 1)
+        self.results = context.Queue()
+        self.pending = 0
+        loader_kwargs = {"batch_size": batch_size, "num_workers": num_workers, "collate_fn": dataset.collate_fn}
+        self.process = context.Process(target = _evaluation_worker,
+                                       args = (copy.deepcopy(model).cpu(), dataset, loader_kwargs, str(device),
+                                               num_threads, print_freq, streaming, self.tasks, self.results),
+                                       daemon = True)
+        self.process.start()
+
+    def submit(self, epoch, model):
+        model = getattr(model, "module", model)
+        state_dict = {k: v.detach().to("cpu", copy = True) for k, v in model.state_dict().items()}
+        self.tasks.put((epoch, state_dict))
+        self.pending += 1
+
+    def poll(self, block = False):
+        finished = []
+        while self.pending > 0:
+            try:
+                finished.append(self.results.get(timeout = 10) if block else self.results.get_nowait())
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError("The evaluation process exited with code {}".format(self.process.exitcode))
+                continue
+            self.pending -= 1
+        return finished
+
+    def close(self):
+        """
+        Wait for the pending evaluations, stop the process and return the evaluations not polled yet
+        """
+        finished = self.poll(block = True)
+        self.tasks.put(None)
+        self.process.join()
+        return finished
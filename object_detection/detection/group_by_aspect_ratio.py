@@ -193,3 +193,32 @@ def create_aspect_ratio_groups(dataset, k=0):
     print("Using {} as bins for aspect ratio quantization".format(fbins))
     print("Count of instances per bin: {}".format(counts))
     return groups
+
+
+def compute_num_objects(dataset, indices=None):
+    if indices is None:
+        indices = range(len(dataset))
+    if isinstance(dataset, torch.utils.data.Subset):
+        return compute_num_objects(dataset.dataset, [dataset.indices[i] for i in indices])
+    return [dataset.get_num_objects(i) for i in indices]
+
+
+def create_size_groups(dataset, k=0, box_groups=1):
+    """
+    Group the images by aspect ratio (as create_aspect_ratio_groups) and by number of objects.
+    GeneralizedRCNNTransform resizes each image to the same scale, so the images of one aspect ratio group are
+    padded little when batched; grouping by number of objects as well (in box_groups quantiles) evens out
+    the cost of the steps.
+    """
+    aspect_ratio_groups = create_aspect_ratio_groups(dataset, k)
+    if box_groups <= 1:
+        return aspect_ratio_groups
+    num_objects = compute_num_objects(dataset)
+    bins = np.unique(np.quantile(num_objects, np.linspace(0, 1, box_groups + 1)[1:-1])).tolist()
+    box_count_groups = _quantize(num_objects, bins)
+    print("Using {} as bins for the number of objects".format([0] + bins + [np.inf]))
+    # number the (aspect ratio, number of objects) groups 0, 1, ...
+    _, groups = np.unique(np.stack([aspect_ratio_groups, box_count_groups]), axis=1, return_inverse=True)
+    groups = groups.reshape(-1).tolist()
+    print("Count of instances per group: {}".format(np.unique(groups, return_counts=True)[1]))
+    return groups
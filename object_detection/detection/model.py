@@ -2,6 +2,12 @@ import time
 import torchvision
 import torch
 import os
+import re
+import pickle
+import random
+import shutil
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 ## Model
 
 def save_checkpoint(epoch, model, optimizer, lr, lr_decay, num_epochs, path):
@@ -19,9 +25,191 @@ def save_checkpoint(epoch, model, optimizer, lr, lr_decay, num_epochs, path):
 
     torch.save(state, os.path.join(path, model_characteristic + filename))
     
-def get_frcnn_model(num_classes, pretrained):
+def _to_cpu(state):
+    """
+    A copy of a (nested) state_dict with every tensor copied to the cpu, so training can go on while it is written
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: _to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(v) for v in state)
+    return state
+
+def get_rng_state():
+    # the numpy key is kept as a tensor, so the checkpoint only holds tensors and python types
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'torch': torch.get_rng_state(),
+             'numpy': (name, torch.from_numpy(key.astype(np.int64)), pos, has_gauss, cached_gaussian),
+             'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    name, key, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, key.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class CheckpointManager(object):
+    """
+    Save the state_dicts of the model, optimizer and scheduler at the end of each epoch, as
+    <directory>/<prefix>checkpoint_frcnn_epoch<epoch>.pth.tar, keeping the last keep_last epochs,
+    plus <prefix>checkpoint_frcnn_best.pth.tar for the epoch with the highest metric (e.g. the COCO mAP).
+    The state is copied to the cpu in save(); the file is written on a background thread, to a temporary file
+    that is then renamed, so a checkpoint on disk is always complete.
+    The metric of an epoch can be given to save(), or later with set_metric() (e.g. from an AsyncEvaluator);
+    an epoch saved with metric_pending is not removed before its metric is known.
+    """
+    def __init__(self, directory, prefix = '', keep_last = 3):
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.best_metric = None
+        self.pending = set()
+        # the metric written in each epoch checkpoint
+        self.metrics = {}
+        pattern = re.compile(re.escape(prefix + 'checkpoint_frcnn_epoch') + r'(\d+)\.pth\.tar$')
+        self.epochs = sorted(int(m.group(1)) for m in map(pattern.match, os.listdir(directory)) if m)
+        if os.path.isfile(self.best_path()):
+            self.best_metric = torch.load(self.best_path(), map_location='cpu').get('metric')
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.futures = []
+
+    def epoch_path(self, epoch):
+        return os.path.join(self.directory, self.prefix + 'checkpoint_frcnn_epoch' + str(epoch) + '.pth.tar')
+
+    def best_path(self):
+        return os.path.join(self.directory, self.prefix + 'checkpoint_frcnn_best.pth.tar')
+
+    def save(self, epoch, model, optimizer, scheduler, metric = None, metric_pending = False, **kwargs):
+        """
+        :param kwargs: saved in the checkpoint as well, e.g. num_classes, image_mean and image_std
+        """
+        model = getattr(model, 'module', model)
+        state = {'epoch': epoch,
+                 'model': _to_cpu(model.state_dict()),
+                 'optimizer': _to_cpu(optimizer.state_dict()),
+                 'lr_scheduler': _to_cpu(scheduler.state_dict()),
+                 'rng_state': get_rng_state(),
+                 # a python float, numpy scalars are not loaded by torch.load(weights_only=True)
+                 'metric': float(metric) if metric is not None else None}
+        state.update(kwargs)
+        if metric_pending:
+            self.pending.add(epoch)
+        self._submit(self._write, epoch, state)
+
+    def set_metric(self, epoch, metric):
+        self._submit(self._score, epoch, float(metric))
+
+    def _submit(self, fn, *args):
+        # raise the errors of the writes done so far
+        for future in [f for f in self.futures if f.done()]:
+            future.result()
+            self.futures.remove(future)
+        self.futures.append(self.executor.submit(fn, *args))
+
+    def _write(self, epoch, state):
+        path = self.epoch_path(epoch)
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.epochs = sorted(set(self.epochs) | {epoch})
+        self.metrics[epoch] = state['metric']
+        if state['metric'] is not None:
+            self._update_best(epoch, state['metric'])
+        self._prune()
+
+    def _prune(self):
+        # the epochs whose metric is pending are kept until it is known
+        for old_epoch in self.epochs[:len(self.epochs) - self.keep_last]:
+            if old_epoch not in self.pending:
+                os.remove(self.epoch_path(old_epoch))
+                self.epochs.remove(old_epoch)
+
+    def _score(self, epoch, metric):
+        self.pending.discard(epoch)
+        self._update_best(epoch, metric)
+        self._prune()
+
+    def _update_best(self, epoch, metric):
+        if self.best_metric is not None and metric <= self.best_metric:
+            return
+        if epoch not in self.epochs:
+            print('The checkpoint of epoch {} was removed before its metric was known'.format(epoch))
+            return
+        self.best_metric = metric
+        tmp_path = self.best_path() + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if self.metrics.get(epoch) == metric:
+            # the epoch checkpoint already holds its metric, link (or copy) it
+            try:
+                os.link(self.epoch_path(epoch), tmp_path)
+            except OSError:
+                shutil.copyfile(self.epoch_path(epoch), tmp_path)
+        else:
+            state = torch.load(self.epoch_path(epoch), map_location='cpu')
+            state['metric'] = metric
+            torch.save(state, tmp_path)
+        os.replace(tmp_path, self.best_path())
+
+    def close(self):
+        """
+        Wait for the checkpoints being written
+        """
+        self.executor.shutdown(wait = True)
+        for future in self.futures:
+            future.result()
+
+def load_checkpoint(path, model, optimizer = None, scheduler = None, restore_rng = True):
+    """
+    Load a checkpoint saved by CheckpointManager into the model (and optimizer and scheduler), to resume training
+    :return: the epoch to start from
+    """
+    checkpoint = torch.load(path, map_location='cpu')
+    getattr(model, 'module', model).load_state_dict(checkpoint['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None:
+        scheduler.load_state_dict(checkpoint['lr_scheduler'])
+    if restore_rng:
+        set_rng_state(checkpoint['rng_state'])
+    return checkpoint['epoch'] + 1
+
+def load_checkpoint_model(path, device):
+    """
+    Load the model of a checkpoint, saved by CheckpointManager or save_checkpoint, on device and in eval mode
+    """
+    try:
+        checkpoint = torch.load(path, map_location=device)
+    except pickle.UnpicklingError:
+        # a checkpoint of save_checkpoint pickles the whole model, which recent torch only loads when asked to
+        checkpoint = torch.load(path, map_location=device, weights_only=False)
+    model = checkpoint['model']
+    if isinstance(model, dict):
+        num_classes = checkpoint.get('num_classes', model['roi_heads.box_predictor.cls_score.weight'].shape[0])
+        state_dict = model
+        # the normalization the model was trained with (see model_train.py --dataset_statistics), ImageNet's if not saved
+        model = get_frcnn_model(num_classes, pretrained = False, pretrained_backbone = False,
+                                image_mean = checkpoint.get('image_mean'), image_std = checkpoint.get('image_std'))
+        model.load_state_dict(state_dict)
+    model.to(device)
+    model.eval()
+    return model
+
+def get_frcnn_model(num_classes, pretrained, pretrained_backbone = True, image_mean = None, image_std = None):
     # load a model pre-trained pre-trained on COCO
-    model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained = pretrained)
+    model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained = pretrained, pretrained_backbone = pretrained_backbone)
+    # normalize the images by the statistics of the dataset (see dataset_statistics.py) instead of ImageNet's
+    if image_mean is not None:
+        model.transform.image_mean = [float(v) for v in image_mean]
+    if image_std is not None:
+        model.transform.image_std = [float(v) for v in image_std]
     #Anchor Generator              
     anchor_sizes = ((8,), (16,),(32,), (64,), (128,))
     aspect_ratios = ((0.5, 1.0, 2.0),) * len(anchor_sizes)
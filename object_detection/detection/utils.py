@@ -1,9 +1,17 @@
 from collections import defaultdict, deque
+import contextlib
 import datetime
 import errno
+import json
 import os
 import time
 
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
 import torch
 import torch.distributed as dist
 
@@ -32,7 +40,8 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=device)
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -113,10 +122,117 @@ def reduce_dict(input_dict, average=True):
     return reduced_dict
 
 
+def get_memory_mb():
+    """
+    The current and peak resident set size of this process, and the peak cuda memory allocated since the last
+    reset, in MB (None where not available)
+    """
+    MB = 1024.0 * 1024.0
+    rss = max_rss = cuda_max = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # kB on linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        cuda_max = torch.cuda.max_memory_allocated() / MB
+    return rss, max_rss, cuda_max
+
+
+class StepProfiler(object):
+    """
+    Time the phases of each training step (data, augment, h2d, forward, backward, optimizer, logging, and the rest
+    as other) and write one json line per step to trace_path, with the last value of each meter of the
+    MetricLogger (e.g. the loss components) and the memory (see get_memory_mb).
+    With chrome_trace_dir, torch.profiler also records the steps in the windows of
+    torch.profiler.schedule(wait, warmup, active, repeat), each saved as a Chrome trace
+    (chrome://tracing or https://ui.perfetto.dev) in which the phases are labelled.
+    Used through MetricLogger(profiler=...): log_every times the data wait and the logging, and the training
+    loop wraps the other phases in metric_logger.phase(name).
+    """
+
+    def __init__(self, trace_path=None, chrome_trace_dir=None, schedule=(10, 2, 5, 1), synchronize=True):
+        """
+        :param schedule: (wait, warmup, active, repeat) steps of the torch.profiler windows
+        :param synchronize: wait for the cuda kernels at the end of each phase, so they are timed in their phase
+        """
+        self.trace_file = open(trace_path, 'a') if trace_path is not None else None
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.epoch = None
+        self.step_num = 0
+        self.times = {}
+        self.torch_profiler = None
+        if chrome_trace_dir is not None:
+            mkdir(chrome_trace_dir)
+            wait, warmup, active, repeat = schedule
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+                on_trace_ready=lambda prof: prof.export_chrome_trace(
+                    os.path.join(chrome_trace_dir, 'trace_step{}.json'.format(prof.step_num))),
+                profile_memory=True, record_shapes=False)
+            self.torch_profiler.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+            if self.synchronize:
+                torch.cuda.synchronize()
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def step(self, step_time, meters=None):
+        """
+        Write the record of the step that just ended, which took step_time seconds
+        """
+        if self.trace_file is not None:
+            rss, max_rss, cuda_max = get_memory_mb()
+            times = dict(self.times)
+            times['other'] = max(0.0, step_time - sum(times.values()))
+            record = {'epoch': self.epoch, 'step': self.step_num, 'time': step_time, 'phases': times,
+                      'meters': {name: meter.value for name, meter in (meters or {}).items() if len(meter.deque)},
+                      'rss_mb': rss, 'max_rss_mb': max_rss, 'cuda_max_mb': cuda_max}
+            self.trace_file.write(json.dumps(record) + '\n')
+            self.trace_file.flush()
+            if cuda_max is not None:
+                torch.cuda.reset_peak_memory_stats()
+        self.times = {}
+        self.step_num += 1
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def close(self):
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+
 class MetricLogger(object):
-    def __init__(self, delimiter="\t"):
+    def __init__(self, delimiter="\t", profiler=None):
+        """
+        :param profiler: an optional StepProfiler, recording the phases of each step of log_every
+        """
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.profiler = profiler
+
+    def phase(self, name):
+        """
+        A context timing a phase of the current step with the profiler (a no-op without one)
+        """
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase(name)
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
@@ -177,24 +293,33 @@ class MetricLogger(object):
                 'data: {data}'
             ])
         MB = 1024.0 * 1024.0
-        for obj in iterable:
+        iterator = iter(iterable)
+        while True:
+            # the profiler (if any) times the wait for the next batch as the data phase
+            with self.phase('data'):
+                obj = next(iterator, StopIteration)
+            if obj is StopIteration:
+                break
             data_time.update(time.time() - end)
             yield obj
             iter_time.update(time.time() - end)
-            if i % print_freq == 0 or i == len(iterable) - 1:
-                eta_seconds = iter_time.global_avg * (len(iterable) - i)
-                eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
-                if torch.cuda.is_available():
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time),
-                        memory=torch.cuda.max_memory_allocated() / MB))
-                else:
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time)))
+            with self.phase('logging'):
+                if i % print_freq == 0 or i == len(iterable) - 1:
+                    eta_seconds = iter_time.global_avg * (len(iterable) - i)
+                    eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
+                    if torch.cuda.is_available():
+                        print(log_msg.format(
+                            i, len(iterable), eta=eta_string,
+                            meters=str(self),
+                            time=str(iter_time), data=str(data_time),
+                            memory=torch.cuda.max_memory_allocated() / MB))
+                    else:
+                        print(log_msg.format(
+                            i, len(iterable), eta=eta_string,
+                            meters=str(self),
+                            time=str(iter_time), data=str(data_time)))
+            if self.profiler is not None:
+                self.profiler.step(time.time() - end, self.meters)
             i += 1
             end = time.time()
         total_time = time.time() - start_time
@@ -285,8 +410,12 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
+    if torch.cuda.is_available() and getattr(args, 'device', None) != 'cpu':
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        # cpu processes, e.g. several on the cores of one host
+        args.dist_backend = 'gloo'
     print('| distributed init (rank {}): {}'.format(
         args.rank, args.dist_url), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
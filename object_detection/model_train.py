@@ -20,6 +20,7 @@ import torchvision.transforms.functional as FT
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 
 import argparse
+import contextlib
 
 import dataset
 import transforms
@@ -27,7 +28,8 @@ import transforms
 import detection
 from detection.coco_utils import get_coco_api_from_dataset
 from detection.coco_eval import CocoEvaluator
-from detection.engine import train_one_epoch, evaluate
+from detection.group_by_aspect_ratio import GroupedBatchSampler, create_size_groups
+from detection.engine import train_one_epoch, evaluate, AsyncEvaluator, get_amp_dtype, make_grad_scaler
 import detection.model 
 
 #python ~/work/cred/AST_dataset/object_detection/model_train.py --parent_directory ~/work/Test --path_to_predefined_classes ~/work/cred/AST_dataset/object_detection/predefined_classes.txt --scheduler_name exponentiallr --lr 0.01 --batch_size 4 
@@ -47,7 +49,13 @@ def get_args_parser():
     
     parser.add_argument('--val_size', type=float, default=0.2,
                         help='The percentage of the data allocated to the validation set')  
+    parser.add_argument('--stable_val_split', action='store_true',
+                        help='Pick the validation images from a hash of their ids, so they stay the same when parse.py --incremental adds or deletes images')
+    parser.add_argument('--annotation_format', type=str, default="json", choices=["json", "store"],
+                        help='Read the objects from the json lists or from the annotation store made by parse.py --annotation_store')
     
+    parser.add_argument('--dataset_statistics', type=str, default=None,
+                        help='Normalize the images by the mean / std saved by dataset_statistics.py in this json file, instead of ImageNet\'s')
     parser.add_argument('--pretrained', type=bool, default=True,
                         help='Whether or not to use the the pretrained model')
     parser.add_argument('--keep_difficult', type=bool, default=True,
@@ -77,14 +85,89 @@ def get_args_parser():
                         help='num_workers')
     parser.add_argument('--batch_size', type=int, default=8,
                         help='The batch size.')
+    parser.add_argument('--aspect_ratio_group_factor', type=int, default=-1,
+                        help='Batch the training images by aspect ratio, in 2k+1 bins (-1 to batch at random)')
+    parser.add_argument('--box_count_groups', type=int, default=1,
+                        help='With --aspect_ratio_group_factor, also batch the images by number of objects, in this many quantile bins')
+    parser.add_argument('--image_cache_gb', type=float, default=0,
+                        help='Size cap (GB) of the memory-mapped cache of decoded train/val images, 0 decodes every image on the fly')
+    parser.add_argument('--transform_backend', type=str, default="pil", choices=["pil", "tensor"],
+                        help='Augment PIL images, or decode straight to tensors and augment the tensors')
+    parser.add_argument('--augmentation', type=str, default="sample", choices=["sample", "batch"],
+                        help='Augment each sample in the data loader workers, or each collated batch in the training loop')
+    parser.add_argument('--augmentation_device', type=str, default="device", choices=["device", "cpu"],
+                        help='With --augmentation batch, augment on the training device or on the cpu of the main process')
+    parser.add_argument('--streaming_evaluation', action='store_true',
+                        help='Evaluate with score histograms, whose memory does not grow with the validation set')
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+                        help='The number of batches whose gradients are accumulated before each optimizer step')
+    parser.add_argument('--no_lr_scaling', dest='lr_scaling', action='store_false',
+                        help='Do not multiply the learning rate by accumulation_steps')
+    parser.add_argument('--amp', type=str, default="none", choices=["none", "auto", "bf16", "fp16"],
+                        help='Train under autocast: bf16, fp16 (with a GradScaler) or auto (bf16 on the cpu, fp16 on gpus)')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='Keep the model weights (and so the convolution activations) in the channels last memory format')
+    parser.add_argument('--checkpoint_directory', type=str, default=None,
+                        help='The directory of the checkpoints, the parent directory by default')
+    parser.add_argument('--keep_checkpoints', type=int, default=3,
+                        help='The number of most recent epoch checkpoints kept, besides the best one')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Path to a checkpoint to resume training from')
+    parser.add_argument('--async_evaluation', action='store_true',
+                        help='Evaluate each epoch in a separate process, while the next epoch trains')
+    parser.add_argument('--evaluation_device', type=str, default="cpu",
+                        help='With --async_evaluation, the device of the evaluation process')
+    parser.add_argument('--evaluation_threads', type=int, default=1,
+                        help='With --async_evaluation, the number of torch threads of the evaluation process')
+    parser.add_argument('--profile_trace', type=str, default=None,
+                        help='Write the time of each phase of each training step, the losses and the memory to this json lines file')
+    parser.add_argument('--profile_chrome_trace_directory', type=str, default=None,
+                        help='Record windows of training steps with torch.profiler, saved as Chrome traces in this directory')
+    parser.add_argument('--profile_schedule', type=int, nargs=4, default=[10, 2, 5, 1],
+                        help='The wait, warmup, active and repeat steps of the torch.profiler windows')
     parser.add_argument('--device', type=str, default=None,
                         help='The device to be used')
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='The number of DistributedDataParallel processes launched on this host (gloo on the cpu, nccl on gpus)')
+    parser.add_argument('--threads_per_process', type=int, default=None,
+                        help='With --nprocs, the number of torch threads of each process, the cpu count / nprocs by default')
+    parser.add_argument('--master_port', type=str, default="29500",
+                        help='With --nprocs, the port of the process group rendezvous')
+    parser.add_argument('--dist_url', type=str, default="env://",
+                        help='The url of the process group rendezvous')
     
     args = parser.parse_args()
     return args 
 
+@contextlib.contextmanager
+def main_process_first(distributed):
+    """
+    Let the main process build the shared files (image sizes, image caches) before the other processes read them
+    """
+    if distributed and not detection.utils.is_main_process():
+        torch.distributed.barrier()
+    yield
+    if distributed and detection.utils.is_main_process():
+        torch.distributed.barrier()
+
+def run_worker(local_rank, args):
+    """
+    The entry point of each process launched with --nprocs
+    """
+    os.environ["RANK"] = os.environ["LOCAL_RANK"] = str(local_rank)
+    os.environ["WORLD_SIZE"] = str(args.nprocs)
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", args.master_port)
+    # split the cores between the processes, instead of each one using all of them
+    torch.set_num_threads(args.threads_per_process or max(1, os.cpu_count() // args.nprocs))
+    main(args)
+
 def main(args):
-    if args.device is None:
+    # a no-op unless launched with --nprocs or torchrun (RANK / WORLD_SIZE set)
+    detection.utils.init_distributed_mode(args)
+    if args.distributed and args.dist_backend == "nccl":
+        device = torch.device("cuda", args.gpu)
+    elif args.device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     else:
         device = torch.device(args.device)
@@ -96,21 +179,54 @@ def main(args):
 
     # Data loading code
     print("Loading data")
-    train_images, train_objects, val_images, val_objects, test_images, test_objects = dataset.split_method(args.parent_directory, "simple_val",  val_size = args.val_size)
+    train_images, train_objects, val_images, val_objects, test_images, test_objects = dataset.split_method(args.parent_directory, "simple_val",  val_size = args.val_size,
+                                                                                                                annotation_format = args.annotation_format,
+                                                                                                                stable_val = args.stable_val_split)
     
-    train_dataset = dataset.pascal_voc_dataset(train_images, train_objects, train = True)
-    val_dataset = dataset.pascal_voc_dataset(val_images, val_objects, train = False)
-    test_dataset = dataset.pascal_voc_dataset(test_images, test_objects, train = False)
+    train_dataset = dataset.pascal_voc_dataset(train_images, train_objects, train = True, backend = args.transform_backend,
+                                               augment = args.augmentation == "sample")
+    val_dataset = dataset.pascal_voc_dataset(val_images, val_objects, train = False, backend = args.transform_backend)
+    test_dataset = dataset.pascal_voc_dataset(test_images, test_objects, train = False, backend = args.transform_backend)
+
+    with main_process_first(args.distributed):
+        # the (height, width) of the images, read once from their headers into image_sizes.json
+        for subset_dataset in [train_dataset, val_dataset, test_dataset]:
+            subset_dataset.image_sizes = dataset.get_image_sizes(args.parent_directory, subset_dataset.images)
+
+        if args.image_cache_gb > 0:
+            # decode the train then the val images once, into caches shared by the data loader workers
+            cache_bytes = int(args.image_cache_gb * 1024 ** 3)
+            for name, subset_dataset in [("train", train_dataset), ("val", val_dataset)]:
+                subset_dataset.image_cache = dataset.DecodedImageCache.build(os.path.join(args.parent_directory, name + "_image_cache"),
+                                                                             subset_dataset.images, cache_bytes)
+                cache_bytes -= subset_dataset.image_cache.nbytes
 
     # Custom dataloaders
     print("Creating data loaders")
-    train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size = args.batch_size, shuffle=True, 
-                                                    num_workers=args.num_workers, collate_fn = train_dataset.collate_fn, pin_memory=True)
-    val_data_loader = torch.utils.data.DataLoader(val_dataset,  batch_size = args.batch_size, shuffle=True, 
+    if args.distributed:
+        # each process trains on, and evaluates, its own shard of the images
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset, shuffle = False)
+    else:
+        train_sampler = torch.utils.data.RandomSampler(train_dataset)
+        val_sampler = torch.utils.data.RandomSampler(val_dataset)
+    if args.aspect_ratio_group_factor >= 0:
+        group_ids = create_size_groups(train_dataset, k = args.aspect_ratio_group_factor, box_groups = args.box_count_groups)
+        train_batch_sampler = GroupedBatchSampler(train_sampler, group_ids, args.batch_size)
+        train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_sampler = train_batch_sampler,
+                                                        num_workers=args.num_workers, collate_fn = train_dataset.collate_fn, pin_memory=True)
+    else:
+        train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size = args.batch_size, sampler = train_sampler, 
+                                                        num_workers=args.num_workers, collate_fn = train_dataset.collate_fn, pin_memory=True)
+    val_data_loader = torch.utils.data.DataLoader(val_dataset,  batch_size = args.batch_size, sampler = val_sampler, 
                                                   num_workers=args.num_workers, collate_fn = val_dataset.collate_fn, pin_memory=pin_memory)
     test_data_loader = torch.utils.data.DataLoader(test_dataset,  batch_size = args.batch_size, shuffle=True, 
                                                   num_workers=args.num_workers, collate_fn = test_dataset.collate_fn, pin_memory=pin_memory)
     
+    batch_transform = None
+    if args.augmentation == "batch":
+        batch_transform = transforms.BatchAugmentation(device if args.augmentation_device == "device" else "cpu")
+
     print("Creating model")
     # Model parameters
     label_map = dataset.get_label_map(args.parent_directory, args.path_to_predefined_classes)
@@ -119,27 +235,91 @@ def main(args):
     num_classes=len(label_map)  # number of different types of objects
 
     # get number of input features for the classifier
-    model = detection.model.get_frcnn_model(num_classes, args.pretrained)
+    image_mean, image_std = transforms.normalize(args.dataset_statistics) if args.dataset_statistics else (None, None)
+    model = detection.model.get_frcnn_model(num_classes, args.pretrained, image_mean = image_mean, image_std = image_std)
     model.to(device)
+    if args.channels_last:
+        model.to(memory_format = torch.channels_last)
+    model_without_ddp = model
+    if args.distributed:
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids = [args.gpu] if device.type == "cuda" else None)
+    amp_dtype = get_amp_dtype(args.amp, device)
+    scaler = make_grad_scaler(amp_dtype, device)
     
     ## Define make_optimizer() and make_scheduler()
     #criterion = nn.CrossEntropyLoss()
-    optimizer = detection.model.make_optimizer(args.optimizer_name, model, lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+    # linear scaling rule: the learning rate grows with the effective batch size, batch_size * accumulation_steps * processes
+    batch_multiple = args.accumulation_steps * detection.utils.get_world_size()
+    lr = args.lr * batch_multiple if args.lr_scaling else args.lr
+    print("Effective batch size {}, learning rate {}".format(args.batch_size * batch_multiple, lr))
+    optimizer = detection.model.make_optimizer(args.optimizer_name, model, lr=lr, momentum=args.momentum, weight_decay=args.weight_decay)
     lr_scheduler = detection.model.make_scheduler(args.scheduler_name, optimizer, milestones=[args.milestones], lr_gamma = args.lr_gamma)
     
-    for epoch in range(args.num_epochs):
+    model_characteristic = "".join(["lr",str(args.lr),"_","lrdecay",str(args.lr_gamma),"_","epoch",str(args.num_epochs)])
+    # only the main process writes checkpoints (the processes hold the same weights) and runs the async evaluation
+    checkpoints = None
+    if detection.utils.is_main_process():
+        checkpoints = detection.model.CheckpointManager(args.checkpoint_directory or args.parent_directory, model_characteristic,
+                                                        keep_last = args.keep_checkpoints)
+    start_epoch = 0
+    if args.resume is not None:
+        start_epoch = detection.model.load_checkpoint(args.resume, model_without_ddp, optimizer, lr_scheduler)
+        print("Resuming from epoch", start_epoch)
+
+    async_evaluator = None
+    if args.async_evaluation and detection.utils.is_main_process():
+        async_evaluator = AsyncEvaluator(model_without_ddp, val_dataset, args.batch_size, args.num_workers, device = args.evaluation_device,
+                                         num_threads = args.evaluation_threads, print_freq = args.print_freq[1],
+                                         streaming = args.streaming_evaluation)
+
+    profiler = None
+    if (args.profile_trace or args.profile_chrome_trace_directory) and detection.utils.is_main_process():
+        profiler = detection.utils.StepProfiler(args.profile_trace, args.profile_chrome_trace_directory,
+                                                schedule = args.profile_schedule)
+
+    for epoch in range(start_epoch, args.num_epochs):
         # train for one epoch, printing every 10 iterations
         print("epoch #:", epoch)
-        train_one_epoch(model, optimizer, lr_scheduler, train_data_loader, device, epoch, print_freq=args.print_freq[0])
+        if args.distributed:
+            train_sampler.set_epoch(epoch)
+        train_one_epoch(model, optimizer, lr_scheduler, train_data_loader, device, epoch, print_freq=args.print_freq[0],
+                        batch_transform=batch_transform, amp_dtype=amp_dtype, scaler=scaler,
+                        accumulation_steps=args.accumulation_steps, profiler=profiler)
         # update the learning rate
         lr_scheduler.step()
         # evaluate on the test dataset
-        evaluate(model, val_data_loader, device = device,print_freq = args.print_freq[1])
         #https://pytorch.org/tutorials/recipes/recipes/saving_and_loading_a_general_checkpoint.html
-        detection.model.save_checkpoint(epoch, model, optimizer, args.lr, args.lr_gamma, args.num_epochs, args.parent_directory)
+        if async_evaluator is not None:
+            async_evaluator.submit(epoch, model_without_ddp)
+            checkpoints.save(epoch, model_without_ddp, optimizer, lr_scheduler, metric_pending = True, num_classes = num_classes,
+                             image_mean = model_without_ddp.transform.image_mean, image_std = model_without_ddp.transform.image_std)
+            for eval_epoch, stats in async_evaluator.poll():
+                print("epoch #{} evaluation: AP {:.3f}, AP50 {:.3f}".format(eval_epoch, stats["bbox"][0], stats["bbox"][1]))
+                checkpoints.set_metric(eval_epoch, stats["bbox"][0])
+        elif not args.async_evaluation:
+            # every process evaluates its shard of the val images; the results are gathered before accumulating
+            coco_evaluator = evaluate(model_without_ddp, val_data_loader, device = device,print_freq = args.print_freq[1], streaming = args.streaming_evaluation)
+            if checkpoints is not None:
+                checkpoints.save(epoch, model_without_ddp, optimizer, lr_scheduler, metric = coco_evaluator.coco_eval["bbox"].stats[0],
+                                 num_classes = num_classes, image_mean = model_without_ddp.transform.image_mean,
+                                 image_std = model_without_ddp.transform.image_std)
+
+    if async_evaluator is not None:
+        for eval_epoch, stats in async_evaluator.close():
+            print("epoch #{} evaluation: AP {:.3f}, AP50 {:.3f}".format(eval_epoch, stats["bbox"][0], stats["bbox"][1]))
+            checkpoints.set_metric(eval_epoch, stats["bbox"][0])
+    if checkpoints is not None:
+        checkpoints.close()
+    if profiler is not None:
+        profiler.close()
+    if args.distributed:
+        torch.distributed.destroy_process_group()
 
 if __name__ == '__main__':
     # Set fixed random number seed
     torch.manual_seed(1)
     args = get_args_parser()
-    main(args)
\ No newline at end of file
+    if args.nprocs > 1:
+        torch.multiprocessing.spawn(run_worker, args = (args,), nprocs = args.nprocs)
+    else:
+        main(args)
\ No newline at end of file
@@ -38,24 +38,76 @@ def get_args_parser():
     
     parser.add_argument('--train_val_percent', type=float, default=0.8,
                         help='The percent of the data seperated into the train/val set')  
+    parser.add_argument('--split_by', type=str, default="random", choices=["random", "tile", "class", "tile_class"],
+                        help='random (the seed 42 split), tile (chips from one tile stay in one set), class (stratified by class) or tile_class')
     parser.add_argument('--bbox_remove', type=int, default=20,
                         help='The pixel wideth/height to remove bboxes')   
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='The number of processes used to parse the annotations, 0 parses them serially')
+    parser.add_argument('--shard_size', type=int, default=1000,
+                        help='The number of image ids parsed by a worker at a time, when num_workers > 0')
+    parser.add_argument('--no_resume', dest='resume', action='store_false',
+                        help='Reparse every shard, instead of reusing the shards completed by an earlier run')
+    parser.add_argument('--annotation_store', action='store_true',
+                        help='Also save the objects of each split as a memory-mappable annotation store (<split>_store)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only parse the annotation files added or changed since the last --incremental run, '
+                             'tracked in annotation_manifest.json; the first run parses everything and saves the manifest')
     args = parser.parse_args()
     return args
 
-def main(args):  
+def parse_all(args):
     if args.complete_img_ids == None:
         dataset.make_list_of_image_ids(args.parent_directory, args.img_directory, args.annotation_directory)
-        dataset.split_train_val_test(args.parent_directory, "img_ids.txt", args.train_val_percent)
+        dataset.split_train_val_test(args.parent_directory, "img_ids.txt", args.train_val_percent,
+                                     split_by = args.split_by, anno_dir = args.annotation_directory)
+    else:
+        dataset.split_train_val_test(args.parent_directory, args.complete_img_ids, args.train_val_percent,
+                                     split_by = args.split_by, anno_dir = args.annotation_directory)
+    if args.num_workers > 0:
+        n_test_images, n_test_objects, path = dataset.create_data_lists_parallel(args.parent_directory, args.img_directory,
+                                                                                 args.annotation_directory, args.path_to_predefined_classes,
+                                                                                 "test_img_id.txt", "test", args.bbox_remove,
+                                                                                 num_workers = args.num_workers, shard_size = args.shard_size,
+                                                                                 resume = args.resume)
+        n_train_val_images, n_train_val_objects, path = dataset.create_data_lists_parallel(args.parent_directory, args.img_directory,
+                                                                                           args.annotation_directory, args.path_to_predefined_classes,
+                                                                                           "train_val_img_id.txt", "train", args.bbox_remove,
+                                                                                           num_workers = args.num_workers, shard_size = args.shard_size,
+                                                                                           resume = args.resume)
     else:
-        dataset.split_train_val_test(args.parent_directory, args.complete_img_ids, args.train_val_percent)
-    n_test_images, n_test_objects, path = dataset.create_data_lists(args.parent_directory, args.img_directory, 
-                                                                    args.annotation_directory, args.path_to_predefined_classes, 
-                                                                    "test_img_id.txt", "test", args.bbox_remove)
-        
-    n_train_val_images, n_train_val_objects, path = dataset.create_data_lists(args.parent_directory, args.img_directory, 
-                                                                              args.annotation_directory, args.path_to_predefined_classes,
-                                                                              "train_val_img_id.txt", "train", args.bbox_remove)
+        n_test_images, n_test_objects, path = dataset.create_data_lists(args.parent_directory, args.img_directory, 
+                                                                        args.annotation_directory, args.path_to_predefined_classes, 
+                                                                        "test_img_id.txt", "test", args.bbox_remove)
+            
+        n_train_val_images, n_train_val_objects, path = dataset.create_data_lists(args.parent_directory, args.img_directory, 
+                                                                                  args.annotation_directory, args.path_to_predefined_classes,
+                                                                                  "train_val_img_id.txt", "train", args.bbox_remove)
+
+    return n_test_images, n_test_objects, n_train_val_images, n_train_val_objects, path
+
+def main(args):  
+    update = args.incremental and dataset.load_annotation_manifest(args.parent_directory) is not None
+    if update:
+        n_test_images, n_test_objects, n_train_val_images, n_train_val_objects = dataset.update_data_lists(
+            args.parent_directory, args.img_directory, args.annotation_directory, args.path_to_predefined_classes,
+            args.train_val_percent, args.bbox_remove, num_workers = args.num_workers, split_by = args.split_by,
+            complete_img_ids = args.complete_img_ids)
+        path = os.path.abspath(args.parent_directory)
+    else:
+        n_test_images, n_test_objects, n_train_val_images, n_train_val_objects, path = parse_all(args)
+        if args.incremental:
+            ids = (dataset.read_img_ids(args.parent_directory, "train_val_img_id.txt") +
+                   dataset.read_img_ids(args.parent_directory, "test_img_id.txt"))
+            anno_path = os.path.join(args.parent_directory, args.annotation_directory)
+            dataset.save_annotation_manifest(args.parent_directory, dataset.build_annotation_manifest(anno_path, ids),
+                                             args.complete_img_ids)
+
+    if args.annotation_store:
+        for subset_name in ["test", "train"]:
+            if update and os.path.isdir(dataset.get_store_dir(args.parent_directory, subset_name)):
+                continue # patched by update_data_lists
+            dataset.create_annotation_store(args.parent_directory, subset_name)
 
     print('\nThere are %d test images containing a total of %d objects. Files have been saved to %s.' % (
            n_test_images, n_test_objects, path))
@@ -51,17 +51,22 @@ class COCOeval:
     #  recall     - [TxKxAxM] max recall for every evaluation setting
     # Note: precision and recall==-1 for settings with no gt objects.
     #
+    # With dense=True (the default), evaluate() runs evaluateDense() instead of evaluateImg() on every
+    # image: the matching is vectorized over the images, area ranges and IoU thresholds, and the results
+    # are stored in the arrays of "evalDense" (see evaluateDense) instead of the "evalImgs" list.
+    #
     # See also coco, mask, pycocoDemo, pycocoEvalDemo
     #
     # Microsoft COCO Toolbox.      version 2.0
     # Data, paper, and tutorials available at:  http://mscoco.org/
     # Code written by Piotr Dollar and Tsung-Yi Lin, 2015.
     # Licensed under the Simplified BSD License [see coco/license.txt]
-    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm'):
+    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm', dense=True):
         '''
         Initialize CocoEval using coco APIs for gt and dt
         :param cocoGt: coco object with ground truth annotations
         :param cocoDt: coco object with detection results
+        :param dense: evaluate with the vectorized evaluateDense instead of evaluateImg
         :return: None
         '''
         if not iouType:
@@ -69,6 +74,8 @@ class COCOeval:
         self.cocoGt   = cocoGt              # ground truth COCO API
         self.cocoDt   = cocoDt              # detections COCO API
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results [KxAxI] elements
+        self.evalDense = {}                 # per-detection evaluation results of evaluateDense
+        self.dense    = dense
         self.eval     = {}                  # accumulated evaluation results
         self._gts = defaultdict(list)       # gt for evaluation
         self._dts = defaultdict(list)       # dt for evaluation
@@ -149,13 +156,17 @@ class COCOeval:
                         for imgId in p.imgIds
                         for catId in catIds}
 
-        evaluateImg = self.evaluateImg
-        maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in p.areaRng
-                 for imgId in p.imgIds
-             ]
+        if self.dense:
+            self.evalImgs = []
+            self.evalDense = self.evaluateDense(catIds)
+        else:
+            evaluateImg = self.evaluateImg
+            maxDet = p.maxDets[-1]
+            self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
+                     for catId in catIds
+                     for areaRng in p.areaRng
+                     for imgId in p.imgIds
+                 ]
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format(toc-tic))
@@ -312,6 +323,134 @@ class COCOeval:
                 'dtIgnore':     dtIg,
             }
 
+    def evaluateDense(self, catIds, chunkSize=1<<18):
+        '''
+        Vectorized evaluateImg for every (category, image) pair.
+        The greedy matching of evaluateImg (each detection, highest score first, takes the unmatched gt with the
+        highest IoU, preferring gts that are not ignored) is run one detection rank at a time, for a chunk of pairs,
+        every area range and every IoU threshold at once. The pairs are sorted by their number of gts and dts before
+        chunking, so the arrays are padded little, and a chunk holds at most chunkSize (pair, gt, dt) elements.
+        :return: dict of dense results, the detections of all pairs are concatenated in evalImgs order
+                 (category, then image, then score):
+                 dtPair     - [N] pair of each detection, catIndex*I + imgIndex
+                 dtRank     - [N] rank of each detection among the detections of its pair
+                 dtScores   - [N] confidence of each detection
+                 dtMatched  - [AxTxN] if the detection is matched at each area range and IoU
+                 dtIgnore   - [AxTxN] ignore flag of the detection at each area range and IoU
+                 gtCount    - [AxP] number of gts that are not ignored in each pair, for each area range
+        '''
+        p = self.params
+        T = len(p.iouThrs)
+        A = len(p.areaRng)
+        I = len(p.imgIds)
+        P = len(catIds) * I
+        aRng = np.array(p.areaRng, dtype=np.float64)
+        iouThrs = np.minimum(np.array(p.iouThrs), 1-1e-10)
+        maxDet = p.maxDets[-1]
+
+        # gather the gts and (sorted, truncated) dts of each pair, as in evaluateImg
+        nGt, nDt, gts, dts, pairIous = [], [], [], [], {}
+        for catId in catIds:
+            for imgId in p.imgIds:
+                if p.useCats:
+                    gt = self._gts[imgId,catId]
+                    dt = self._dts[imgId,catId]
+                else:
+                    gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
+                    dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
+                if len(dt) > 1:
+                    dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
+                    dt = [dt[i] for i in dtind[0:maxDet]]
+                nGt.append(len(gt))
+                nDt.append(len(dt))
+                gts.extend(gt)
+                dts.extend(dt)
+                if len(gt) > 0 and len(dt) > 0:
+                    pairIous[len(nGt)-1] = np.asarray(self.ious[imgId, catId], dtype=np.float64)
+        nGt = np.array(nGt, dtype=np.int64)
+        nDt = np.array(nDt, dtype=np.int64)
+        gtStart = np.concatenate([[0], np.cumsum(nGt)[:-1]]).astype(np.int64)
+        dtStart = np.concatenate([[0], np.cumsum(nDt)[:-1]]).astype(np.int64)
+        gtArea = np.array([g['area'] for g in gts], dtype=np.float64)
+        gtIgnore = np.array([bool(g['ignore']) for g in gts], dtype=bool)
+        gtCrowd = np.array([bool(g['iscrowd']) for g in gts], dtype=bool)
+        dtArea = np.array([d['area'] for d in dts], dtype=np.float64)
+        # [AxG] and [AxN] flags of the gts and dts outside of each area range
+        gtOutside = (gtArea[None] < aRng[:,0:1]) | (gtArea[None] > aRng[:,1:2])
+        dtOutside = (dtArea[None] < aRng[:,0:1]) | (dtArea[None] > aRng[:,1:2])
+        gtIgnoreA = gtIgnore[None] | gtOutside
+
+        N = len(dts)
+        dtMatched = np.zeros((A,T,N), dtype=bool)
+        dtIgnore = np.zeros((A,T,N), dtype=bool)
+        gtPair = np.repeat(np.arange(P), nGt)
+        gtCount = np.stack([np.bincount(gtPair[~gtIgnoreA[a]], minlength=P) for a in range(A)]) if P else np.zeros((A,0), dtype=np.int64)
+
+        # chunk the pairs with detections
+        order = [pair for pair in np.lexsort((nDt, nGt)) if nDt[pair] > 0]
+        chunks, chunk, chunkD = [], [], 0
+        for pair in order:
+            chunkD = max(chunkD, nDt[pair])
+            if chunk and (len(chunk)+1) * max(nGt[pair],1) * chunkD > chunkSize:
+                chunks.append(chunk)
+                chunk, chunkD = [], nDt[pair]
+            chunk.append(pair)
+        if chunk:
+            chunks.append(chunk)
+
+        for chunk in chunks:
+            C = len(chunk)
+            G = max(int(nGt[chunk].max()), 1)
+            D = int(nDt[chunk].max())
+            # pad, with an IoU of -1 that never reaches a threshold
+            ious = -np.ones((C,D,G))
+            gtIg = np.ones((C,A,G), dtype=bool)
+            crowd = np.zeros((C,G), dtype=bool)
+            outside = np.zeros((C,A,D), dtype=bool)
+            for c, pair in enumerate(chunk):
+                g, d = nGt[pair], nDt[pair]
+                if g > 0:
+                    ious[c,:d,:g] = pairIous[pair]
+                    gtIg[c,:,:g] = gtIgnoreA[:,gtStart[pair]:gtStart[pair]+g]
+                    crowd[c,:g] = gtCrowd[gtStart[pair]:gtStart[pair]+g]
+                outside[c,:,:d] = dtOutside[:,dtStart[pair]:dtStart[pair]+d]
+
+            free = np.ones((C,A,T,G), dtype=bool)
+            found = np.zeros((C,A,T,D), dtype=bool)
+            foundIg = np.zeros((C,A,T,D), dtype=bool)
+            for d in range(D):
+                iou = ious[:,d,:][:,None,None,:]
+                # candidates: free gts over the threshold; the gts that are not ignored come first
+                cand = free & (iou >= iouThrs[None,None,:,None])
+                regular = cand & ~gtIg[:,:,None,:]
+                cand = np.where(regular.any(axis=-1, keepdims=True), regular, cand)
+                # best IoU, the last of equal IoUs as in evaluateImg
+                best = np.where(cand, iou, -np.inf)[...,::-1].argmax(axis=-1)
+                m = G-1 - best
+                hit = cand.any(axis=-1)
+                found[...,d] = hit
+                foundIg[...,d] = np.take_along_axis(np.broadcast_to(gtIg[:,:,None,:], cand.shape), m[...,None], axis=-1)[...,0] & hit
+                taken = np.zeros_like(cand)
+                np.put_along_axis(taken, m[...,None], hit[...,None], axis=-1)
+                free &= ~taken | crowd[:,None,None,:]
+            # set unmatched detections outside of area range to ignore
+            ignored = foundIg | (~found & outside[:,:,None,:])
+
+            valid = np.arange(D)[None] < nDt[chunk][:,None]
+            pos = (dtStart[chunk][:,None] + np.arange(D)[None])[valid]
+            dtMatched[:,:,pos] = np.moveaxis(found, 0, 2)[:,:,valid]
+            dtIgnore[:,:,pos] = np.moveaxis(ignored, 0, 2)[:,:,valid]
+
+        dtPair = np.repeat(np.arange(P), nDt)
+        return {
+                'dtPair':       dtPair,
+                'dtRank':       np.arange(N) - dtStart[dtPair],
+                'dtScores':     np.array([d['score'] for d in dts], dtype=np.float64),
+                'dtMatched':    dtMatched,
+                'dtIgnore':     dtIgnore,
+                'gtCount':      gtCount,
+            }
+
     def accumulate(self, p = None):
         '''
         Accumulate per image evaluation results and store the result in self.eval
@@ -320,7 +459,7 @@ class COCOeval:
         '''
         print('Accumulating evaluation results...')
         tic = time.time()
-        if not self.evalImgs:
+        if not self.evalImgs and not self.evalDense:
             print('Please run evaluate() first')
         # allows input customized parameters
         if p is None:
@@ -349,8 +488,10 @@ class COCOeval:
         i_list = [n for n, i in enumerate(p.imgIds)  if i in setI]
         I0 = len(_pe.imgIds)
         A0 = len(_pe.areaRng)
+        if self.evalDense:
+            self._accumulateDense(p, precision, recall, scores, k_list, a_list, m_list, i_list, I0)
         # retrieve E at each category, area range, and max number of detections
-        for k, k0 in enumerate(k_list):
+        for k, k0 in enumerate(k_list if not self.evalDense else []):
             Nk = k0*A0*I0
             for a, a0 in enumerate(a_list):
                 Na = a0*I0
@@ -375,8 +516,8 @@ class COCOeval:
                     tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
                     for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
                         tp = np.array(tp)
                         fp = np.array(fp)
@@ -419,6 +560,50 @@ class COCOeval:
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format( toc-tic))
 
+    def _accumulateDense(self, p, precision, recall, scores, k_list, a_list, m_list, i_list, I0):
+        '''
+        The loop of accumulate over the dense results of evaluateDense, filling precision, recall and scores in place
+        '''
+        E = self.evalDense
+        R = len(p.recThrs)
+        dtK = E['dtPair'] // I0
+        imgSelected = np.zeros(I0, dtype=bool)
+        imgSelected[i_list] = True
+        dtSelected = imgSelected[E['dtPair'] % I0]
+        for k, k0 in enumerate(k_list):
+            inK = dtSelected & (dtK == k0)
+            for a, a0 in enumerate(a_list):
+                npig = E['gtCount'][a0, k0*I0 + np.array(i_list, dtype=np.int64)].sum()
+                if npig == 0:
+                    continue
+                for m, maxDet in enumerate(m_list):
+                    sel = np.flatnonzero(inK & (E['dtRank'] < maxDet))
+                    dtScores = E['dtScores'][sel]
+                    inds = np.argsort(-dtScores, kind='mergesort')
+                    dtScoresSorted = dtScores[inds]
+                    dtm  = E['dtMatched'][a0][:,sel[inds]]
+                    dtIg = E['dtIgnore'][a0][:,sel[inds]]
+                    tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
+                    fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
+
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                    nd = tp_sum.shape[1]
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+                    recall[:,k,a,m] = rc[:,-1] if nd else 0
+                    # make the precision monotonically decreasing
+                    pr = np.maximum.accumulate(pr[:,::-1], axis=1)[:,::-1]
+                    for t in range(len(p.iouThrs)):
+                        inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                        valid = inds < nd
+                        q  = np.zeros((R,))
+                        ss = np.zeros((R,))
+                        q[valid] = pr[t, inds[valid]]
+                        ss[valid] = dtScoresSorted[inds[valid]]
+                        precision[t,:,k,a,m] = q
+                        scores[t,:,k,a,m] = ss
+
     def summarize(self):
         '''
         Compute and display summary metrics for evaluation results.
@@ -513,8 +698,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [1, 10, 100]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'small', 'medium', 'large']
@@ -524,8 +709,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [20]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'medium', 'large']
@@ -59,6 +59,60 @@ def find_jaccard_overlap(set_1, set_2):
 
     return intersection / union  # (n1, n2)
 
+def find_paired_jaccard_overlap(set_1, set_2):
+    """
+    Find the Jaccard Overlap (IoU) of each box in set 1 with the box in the same row of set 2.
+
+    :param set_1: set 1, a tensor of dimensions (n, 4)
+    :param set_2: set 2, a tensor of dimensions (n, 4)
+    :return: Jaccard Overlap of each pair of boxes, a tensor of dimensions (n)
+    """
+    lower_bounds = torch.max(set_1[:, :2], set_2[:, :2])  # (n, 2)
+    upper_bounds = torch.min(set_1[:, 2:], set_2[:, 2:])  # (n, 2)
+    intersection_dims = torch.clamp(upper_bounds - lower_bounds, min=0)  # (n, 2)
+    intersection = intersection_dims[:, 0] * intersection_dims[:, 1]  # (n)
+
+    areas_set_1 = (set_1[:, 2] - set_1[:, 0]) * (set_1[:, 3] - set_1[:, 1])  # (n)
+    areas_set_2 = (set_2[:, 2] - set_2[:, 0]) * (set_2[:, 3] - set_2[:, 1])  # (n)
+    union = areas_set_1 + areas_set_2 - intersection  # (n)
+
+    return intersection / union  # (n)
+
+def find_max_overlap(det_images, det_boxes, true_images, true_boxes):
+    """
+    Find, for every detection, the object of the same image that it overlaps most.
+    The objects are grouped by image with a sorted index, and the overlaps of all (detection, object of the same image)
+    pairs are computed in one call, so the cost is linear in the number of pairs.
+
+    :param det_images: image of each detection, a tensor of dimensions (n_detections)
+    :param det_boxes: detected boxes, a tensor of dimensions (n_detections, 4)
+    :param true_images: image of each object, a tensor of dimensions (n_objects)
+    :param true_boxes: object boxes, a tensor of dimensions (n_objects, 4)
+    :return: maximum overlap of each detection (-1 if its image has no objects), a tensor of dimensions (n_detections),
+             and the index of the object with that overlap (the first one, on ties), a tensor of dimensions (n_detections)
+    """
+    device = det_boxes.device
+    n_detections = det_images.size(0)
+    sorted_true_images, true_order = torch.sort(true_images, stable=True)  # (n_objects)
+    starts = torch.searchsorted(sorted_true_images, det_images)  # (n_detections)
+    counts = torch.searchsorted(sorted_true_images, det_images, right=True) - starts  # (n_detections)
+
+    # One row for each (detection, object of the same image) pair
+    pair_dets = torch.repeat_interleave(torch.arange(n_detections, device=device), counts)  # (n_pairs)
+    pair_offsets = torch.arange(pair_dets.size(0), device=device) - torch.repeat_interleave(
+        torch.cumsum(counts, dim=0) - counts, counts)  # (n_pairs)
+    pair_objects = true_order[starts[pair_dets] + pair_offsets]  # (n_pairs)
+    overlaps = find_paired_jaccard_overlap(det_boxes[pair_dets], true_boxes[pair_objects])  # (n_pairs)
+
+    max_overlap = torch.full((n_detections,), -1., device=device).scatter_reduce(
+        0, pair_dets, overlaps, reduce='amax')  # (n_detections)
+    # on ties, the first object of the image, as torch.max does
+    is_max = overlaps == max_overlap[pair_dets]  # (n_pairs)
+    ind = torch.full((n_detections,), true_images.size(0), dtype=torch.long, device=device).scatter_reduce(
+        0, pair_dets[is_max], pair_objects[is_max], reduce='amin')  # (n_detections)
+    ind[counts == 0] = 0
+    return max_overlap, ind
+
 def calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, true_difficulties, label_map):
     """
     Calculate the Mean Average Precision (mAP) of detected objects.
@@ -77,6 +131,7 @@ def calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, tr
         true_labels) == len(
         true_difficulties)  # these are all lists of tensors of the same length, i.e. number of images
     n_classes = len(label_map)
+    device = true_boxes[0].device if len(true_boxes) > 0 else torch.device('cpu')
 
     # Store all (true) objects in a single continuous tensor while keeping track of the image it is from
     true_images = list()
@@ -110,11 +165,6 @@ def calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, tr
         true_class_difficulties = true_difficulties[true_labels == c]  # (n_class_objects)
         n_easy_class_objects = (1 - true_class_difficulties).sum().item()  # ignore difficult objects
 
-        # Keep track of which true objects with this class have already been 'detected'
-        # So far, none
-        true_class_boxes_detected = torch.zeros((true_class_difficulties.size(0)), dtype=torch.uint8).to(
-            device)  # (n_class_objects)
-
         # Extract only detections with this class
         det_class_images = det_images[det_labels == c]  # (n_class_detections)
         det_class_boxes = det_boxes[det_labels == c]  # (n_class_detections, 4)
@@ -128,44 +178,24 @@ def calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, tr
         det_class_images = det_class_images[sort_ind]  # (n_class_detections)
         det_class_boxes = det_class_boxes[sort_ind]  # (n_class_detections, 4)
 
-        # In the order of decreasing scores, check if true or false positive
-        true_positives = torch.zeros((n_class_detections), dtype=torch.float).to(device)  # (n_class_detections)
-        false_positives = torch.zeros((n_class_detections), dtype=torch.float).to(device)  # (n_class_detections)
-        for d in range(n_class_detections):
-            this_detection_box = det_class_boxes[d].unsqueeze(0)  # (1, 4)
-            this_image = det_class_images[d]  # (), scalar
-
-            # Find objects in the same image with this class, their difficulties, and whether they have been detected before
-            object_boxes = true_class_boxes[true_class_images == this_image]  # (n_class_objects_in_img)
-            object_difficulties = true_class_difficulties[true_class_images == this_image]  # (n_class_objects_in_img)
-            # If no such object in this image, then the detection is a false positive
-            if object_boxes.size(0) == 0:
-                false_positives[d] = 1
-                continue
-
-            # Find maximum overlap of this detection with objects in this image of this class
-            overlaps = find_jaccard_overlap(this_detection_box, object_boxes)  # (1, n_class_objects_in_img)
-            max_overlap, ind = torch.max(overlaps.squeeze(0), dim=0)  # (), () - scalars
-
-            # 'ind' is the index of the object in these image-level tensors 'object_boxes', 'object_difficulties'
-            # In the original class-level tensors 'true_class_boxes', etc., 'ind' corresponds to object with index...
-            original_ind = torch.LongTensor(range(true_class_boxes.size(0)))[true_class_images == this_image][ind]
-            # We need 'original_ind' to update 'true_class_boxes_detected'
-
-            # If the maximum overlap is greater than the threshold of 0.5, it's a match
-            if max_overlap.item() > 0.5:
-                # If the object it matched with is 'difficult', ignore it
-                if object_difficulties[ind] == 0:
-                    # If this object has already not been detected, it's a true positive
-                    if true_class_boxes_detected[original_ind] == 0:
-                        true_positives[d] = 1
-                        true_class_boxes_detected[original_ind] = 1  # this object has now been detected/accounted for
-                    # Otherwise, it's a false positive (since this object is already accounted for)
-                    else:
-                        false_positives[d] = 1
-            # Otherwise, the detection occurs in a different location than the actual object, and is a false positive
-            else:
-                false_positives[d] = 1
+        # Find the object of the same image that each detection overlaps most
+        max_overlap, ind = find_max_overlap(det_class_images, det_class_boxes, true_class_images,
+                                            true_class_boxes)  # (n_class_detections), (n_class_detections)
+
+        # If the maximum overlap is greater than the threshold of 0.5, it's a match
+        matched = max_overlap > 0.5  # (n_class_detections)
+        # If the object it matched with is 'difficult', ignore it
+        easy_matched = matched & (true_class_difficulties[ind] == 0) if true_class_boxes.size(0) > 0 else matched
+        # In the order of decreasing scores, the first detection of an object is a true positive, and the
+        # following ones are false positives (since this object is already accounted for)
+        positions = torch.arange(n_class_detections, device=device)  # (n_class_detections)
+        first_detection = torch.full((true_class_boxes.size(0),), n_class_detections, dtype=torch.long,
+                                     device=device).scatter_reduce(0, ind[easy_matched], positions[easy_matched],
+                                                                   reduce='amin')  # (n_class_objects)
+        is_first = easy_matched & (first_detection[ind] == positions) if true_class_boxes.size(0) > 0 else easy_matched
+        true_positives = is_first.float()  # (n_class_detections)
+        # Unmatched detections, and detections of objects that were already detected, are false positives
+        false_positives = (~matched | (easy_matched & ~is_first)).float()  # (n_class_detections)
 
         # Compute cumulative precision and recall at each detection in the order of decreasing scores
         cumul_true_positives = torch.cumsum(true_positives, dim=0)  # (n_class_detections)
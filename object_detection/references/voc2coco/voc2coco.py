@@ -1,11 +1,15 @@
 import os
 import argparse
 import json
+import shutil
 import xml.etree.ElementTree as ET
-from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
 from tqdm import tqdm
 import re
 
+import numpy as np
+
 
 def get_label2id(labels_path: str) -> Dict[str, int]:
     """id is 1 start"""
@@ -117,6 +121,137 @@ def convert_xmls_to_cocojson(annotation_paths: List[str],
         f.write(output_json)
 
 
+def parse_xml_chunk(chunk_args):
+    """Parse a chunk of xmls in a worker process, returns the (image info, annotations without id) of each"""
+    annotation_paths, label2id, extract_num_from_imgid = chunk_args
+    parsed = []
+    for a_path in annotation_paths:
+        ann_root = ET.parse(a_path).getroot()
+        img_info = get_image_info(annotation_root=ann_root,
+                                  extract_num_from_imgid=extract_num_from_imgid)
+        anns = [get_coco_annotation_from_obj(obj=obj, label2id=label2id) for obj in ann_root.findall('object')]
+        parsed.append((img_info, anns))
+    return parsed
+
+
+class JsonArrayWriter:
+    """Write the items of a json array one at a time, separated like json.dumps does"""
+    def __init__(self, f):
+        self.f = f
+        self.n_items = 0
+
+    def write(self, item):
+        if self.n_items > 0:
+            self.f.write(', ')
+        self.f.write(json.dumps(item))
+        self.n_items += 1
+
+
+class CocoSidecarWriter:
+    """Collect the images and annotations as numpy arrays (one per field and chunk), saved to a .npz loaded by load_coco_sidecar"""
+    image_keys = ['id', 'height', 'width', 'file_name']
+    annotation_keys = ['id', 'image_id', 'category_id', 'bbox', 'area', 'iscrowd', 'ignore']
+
+    def __init__(self):
+        self.arrays = {'images_' + key: [] for key in self.image_keys}
+        self.arrays.update({'annotations_' + key: [] for key in self.annotation_keys})
+
+    def add(self, parsed):
+        columns = {'images_' + key: [img_info[key] for img_info, _ in parsed] for key in self.image_keys}
+        columns.update({'annotations_' + key: [ann[key] for _, anns in parsed for ann in anns] for key in self.annotation_keys})
+        for key, values in columns.items():
+            if len(values) > 0:
+                # integers, except the file names and the image ids without extract_num_from_imgid
+                self.arrays[key].append(np.asarray(values))
+
+    def save(self, path: str, label2id: Dict[str, int]):
+        arrays = {key: np.concatenate(chunks) if chunks else np.zeros((0, 4) if key == 'annotations_bbox' else 0, dtype=np.int64)
+                  for key, chunks in self.arrays.items()}
+        arrays['categories_name'] = np.asarray(list(label2id.keys()), dtype=str)
+        arrays['categories_id'] = np.asarray(list(label2id.values()), dtype=np.int64)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+
+
+def convert_xmls_to_cocojson_streaming(annotation_paths: List[str],
+                                       label2id: Dict[str, int],
+                                       output_jsonpath: str,
+                                       extract_num_from_imgid: bool = True,
+                                       num_workers: int = 0,
+                                       chunk_size: int = 1000,
+                                       sidecar_path: Optional[str] = None):
+    """
+    Write the same json as convert_xmls_to_cocojson without holding it in memory: the xmls are parsed in chunks
+    (by num_workers processes, or in this process with 0) and each image and annotation is written as it is parsed.
+    The annotations are spooled to a temporary file until the images array is complete.
+    With sidecar_path, the images, annotations and categories are also saved as numpy arrays (see load_coco_sidecar)
+    """
+    chunks = [(annotation_paths[i:i + chunk_size], label2id, extract_num_from_imgid)
+              for i in range(0, len(annotation_paths), chunk_size)]
+    sidecar = CocoSidecarWriter() if sidecar_path is not None else None
+    tmp_path = output_jsonpath + '.tmp'
+    spool_path = output_jsonpath + '.annotations.tmp'
+    bnd_id = 1  # START_BOUNDING_BOX_ID
+    print('Start converting !')
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+    try:
+        parsed_chunks = executor.map(parse_xml_chunk, chunks) if executor is not None else map(parse_xml_chunk, chunks)
+        with open(tmp_path, 'w') as f, open(spool_path, 'w') as spool:
+            f.write('{"images": [')
+            images_writer = JsonArrayWriter(f)
+            annotations_writer = JsonArrayWriter(spool)
+            # executor.map yields the chunks in order, so the ids are the same as convert_xmls_to_cocojson's
+            for parsed in tqdm(parsed_chunks, total=len(chunks)):
+                for img_info, anns in parsed:
+                    images_writer.write(img_info)
+                    for ann in anns:
+                        ann.update({'image_id': img_info['id'], 'id': bnd_id})
+                        annotations_writer.write(ann)
+                        bnd_id = bnd_id + 1
+                if sidecar is not None:
+                    sidecar.add(parsed)
+            f.write('], "type": "instances", "annotations": [')
+            spool.close()
+            with open(spool_path, 'r') as spool:
+                shutil.copyfileobj(spool, f)
+            f.write('], "categories": [')
+            categories_writer = JsonArrayWriter(f)
+            for label, label_id in label2id.items():
+                categories_writer.write({'supercategory': 'none', 'id': label_id, 'name': label})
+            f.write(']}')
+        os.replace(tmp_path, output_jsonpath)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+    if sidecar is not None:
+        sidecar.save(sidecar_path, label2id)
+
+
+def load_coco_sidecar(sidecar_path: str):
+    """Build the pycocotools COCO ground truth from a sidecar saved by convert_xmls_to_cocojson_streaming, without parsing the json"""
+    from pycocotools.coco import COCO
+    arrays = np.load(sidecar_path)
+    images = [{'file_name': file_name, 'height': height, 'width': width, 'id': img_id}
+              for file_name, height, width, img_id in zip(arrays['images_file_name'].tolist(), arrays['images_height'].tolist(),
+                                                          arrays['images_width'].tolist(), arrays['images_id'].tolist())]
+    annotations = [{'area': area, 'iscrowd': iscrowd, 'bbox': bbox, 'category_id': category_id, 'ignore': ignore,
+                    'segmentation': [], 'image_id': image_id, 'id': ann_id}
+                   for area, iscrowd, bbox, category_id, ignore, image_id, ann_id in zip(
+                       arrays['annotations_area'].tolist(), arrays['annotations_iscrowd'].tolist(),
+                       arrays['annotations_bbox'].tolist(), arrays['annotations_category_id'].tolist(),
+                       arrays['annotations_ignore'].tolist(), arrays['annotations_image_id'].tolist(),
+                       arrays['annotations_id'].tolist())]
+    categories = [{'supercategory': 'none', 'id': category_id, 'name': name}
+                  for name, category_id in zip(arrays['categories_name'].tolist(), arrays['categories_id'].tolist())]
+    coco = COCO()
+    coco.dataset = {'images': images, 'type': 'instances', 'annotations': annotations, 'categories': categories}
+    coco.createIndex()
+    return coco
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='This script support converting voc format xmls to coco format json')
@@ -132,6 +267,12 @@ def main():
     parser.add_argument('--ext', type=str, default='', help='additional extension of annotation file')
     parser.add_argument('--extract_num_from_imgid', action="store_true",
                         help='Extract image number from the image filename')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='number of processes parsing the xmls, 0 to parse them in this process')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='number of xmls parsed by a worker at a time')
+    parser.add_argument('--sidecar', type=str, default=None,
+                        help='also save the annotations as numpy arrays to this .npz, loaded by load_coco_sidecar')
     args = parser.parse_args()
     label2id = get_label2id(labels_path=args.labels)
     ann_paths = get_annpaths(
@@ -140,11 +281,14 @@ def main():
         ext=args.ext,
         annpaths_list_path=args.ann_paths_list
     )
-    convert_xmls_to_cocojson(
+    convert_xmls_to_cocojson_streaming(
         annotation_paths=ann_paths,
         label2id=label2id,
         output_jsonpath=args.output,
-        extract_num_from_imgid=args.extract_num_from_imgid
+        extract_num_from_imgid=args.extract_num_from_imgid,
+        num_workers=args.num_workers,
+        chunk_size=args.chunk_size,
+        sidecar_path=args.sidecar
     )
 
 
@@ -1,8 +1,10 @@
+import json
 import torch
 import torchvision
 import random 
 
 import torchvision.transforms.functional as FT
+from torchvision.io import read_image, ImageReadMode
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -78,33 +80,245 @@ def vflip(image, boxes, p = 0.5):
     return new_image, new_boxes
 
 
-def normalize():
+def read_image_tensor(image_path):
     """
-    Function to calculate the mean and standard deviation for the dataset to use
-    for the normalization 
-    
-    loader = DataLoader(train_set, batch_size=len(train_set), num_workers=1)
-    data = next(iter(loader))
-    data[0].mean(), data[0].std()
-    """
-    nimages = 0
-    mean = 0.0
-    var = 0.0
-    for i_batch, batch_target in enumerate(trainloader):
-        batch = batch_target[0]
-        # Rearrange batch to be the shape of [B, C, W * H]
-        batch = batch.view(batch.size(0), batch.size(1), -1)
-        # Update total number of images
-        nimages += batch.size(0)
-        # Compute mean and std here
-        mean += batch.mean(2).sum(0) 
-        var += batch.var(2).sum(0)
-
-    mean /= nimages
-    var /= nimages
-    std = torch.sqrt(var)
-
-    return(mean,std)
+    Decode an image file straight to a uint8 tensor of dimensions (3, H, W), without going through PIL
+    :param image_path: path to a jpg or png image
+    :return: image, a uint8 tensor
+    """
+    return read_image(image_path, mode = ImageReadMode.RGB)
+
+def hflip_tensor(image, boxes, p = 0.5):
+    """
+    Flip image horizontally, the tensor equivalent of hflip.
+    :param image: image, a tensor of dimensions (3, H, W)
+    :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :return: flipped image, updated bounding box coordinates
+    """
+    new_image = image
+    new_boxes = boxes
+    if random.random() < p:
+        new_image = image.flip(-1)
+        width = image.size(-1)
+        new_boxes = torch.stack([width - boxes[:, 2] - 1, boxes[:, 1], width - boxes[:, 0] - 1, boxes[:, 3]], dim = 1)
+    return new_image, new_boxes
+
+def vflip_tensor(image, boxes, p = 0.5):
+    """
+    Flip image vertically, the tensor equivalent of vflip.
+    :param image: image, a tensor of dimensions (3, H, W)
+    :param boxes: bounding boxes in boundary coordinates, a tensor of dimensions (n_objects, 4)
+    :return: flipped image, updated bounding box coordinates
+    """
+    new_image = image
+    new_boxes = boxes
+    if random.random() < p:
+        new_image = image.flip(-2)
+        height = image.size(-2)
+        new_boxes = torch.stack([boxes[:, 0], height - boxes[:, 3], boxes[:, 2], height - boxes[:, 1]], dim = 1)
+    return new_image, new_boxes
+
+def get_tensor_transform(image, boxes, labels, difficulties, split):
+    """
+    Apply the same transformations as get_transform to an image that is already a tensor.
+    The torchvision adjust_* functions used by photometric_distort work on tensors as well as PIL images,
+    so there is no PIL image made (and copied) for each transformation.
+    :param image: image, a uint8 tensor of dimensions (3, H, W), e.g. from read_image_tensor
+    :param split: one of 'TRAIN' or 'TEST', since different sets of transformations are applied
+    :return: transformed float image in [0, 1], transformed bounding box coordinates, transformed labels, transformed difficulties
+    """
+    assert split.lower() in {'train', 'test'}
+
+    new_image = FT.convert_image_dtype(image, torch.float)
+    new_boxes = boxes
+
+    if split == 'train': #complete each transform with a 50% probability
+        new_image = photometric_distort(new_image)
+        new_image, new_boxes = hflip_tensor(new_image, new_boxes)
+        new_image, new_boxes = vflip_tensor(new_image, new_boxes)
+
+    return new_image, new_boxes, labels, difficulties
+
+# Batch augmentation
+# The functions below take a collated batch of float images in [0, 1], of dimensions (N, 3, H, W),
+# and apply the distortions of get_transform with parameters sampled separately for each image,
+# as tensors on the device of the images, so the whole batch is transformed in a few broadcast operations.
+
+def _blend(images, other, ratio):
+    return (ratio * images + (1.0 - ratio) * other).clamp_(0.0, 1.0)
+
+def _rgb_to_grayscale(images):
+    r, g, b = images.unbind(dim = -3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim = -3)
+
+def _rgb_to_hsv(images):
+    r, g, b = images.unbind(dim = -3)
+    maxc = images.max(dim = -3).values
+    minc = images.min(dim = -3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim = -3)
+
+def _hsv_to_rgb(images):
+    h, s, v = images.unbind(dim = -3)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype = torch.int32) % 6
+    p = torch.clamp(v * (1.0 - s), 0.0, 1.0)
+    q = torch.clamp(v * (1.0 - s * f), 0.0, 1.0)
+    t = torch.clamp(v * (1.0 - s * (1.0 - f)), 0.0, 1.0)
+    mask = i.unsqueeze(dim = -3) == torch.arange(6, device = i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim = -3)
+    a2 = torch.stack((t, v, v, q, p, p), dim = -3)
+    a3 = torch.stack((p, p, t, v, v, q), dim = -3)
+    a4 = torch.stack((a1, a2, a3), dim = -4)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(dtype = images.dtype), a4)
+
+def batch_adjust_brightness(images, factors):
+    """
+    :param factors: brightness factor of each image, a tensor of dimensions (N)
+    """
+    return (images * factors.view(-1, 1, 1, 1)).clamp_(0.0, 1.0)
+
+def batch_adjust_contrast(images, factors):
+    mean = _rgb_to_grayscale(images).mean(dim = (-3, -2, -1), keepdim = True)
+    return _blend(images, mean, factors.view(-1, 1, 1, 1))
+
+def batch_adjust_saturation(images, factors):
+    return _blend(images, _rgb_to_grayscale(images), factors.view(-1, 1, 1, 1))
+
+def batch_adjust_hue(images, factors):
+    """
+    :param factors: hue shift of each image in [-0.5, 0.5], a tensor of dimensions (N)
+    """
+    hsv = _rgb_to_hsv(images)
+    h, s, v = hsv.unbind(dim = -3)
+    h = torch.remainder(h + factors.view(-1, 1, 1), 1.0)
+    return _hsv_to_rgb(torch.stack((h, s, v), dim = -3))
+
+def batch_photometric_distort(images, p = 0.5, generator = None):
+    """
+    Distort brightness, contrast, saturation, and hue of each image in a batch, each with a probability p, using the
+    same factor ranges as photometric_distort. The order of the distortions is shuffled once per batch; whether a
+    distortion is applied, and its factor, are sampled per image (images it is not applied to get the identity factor).
+    :param images: batch of float images in [0, 1], a tensor of dimensions (N, 3, H, W)
+    :return: distorted images
+    """
+    n = images.size(0)
+    distortions = [(batch_adjust_brightness, 0.5, 1.5, 1.0),
+                   (batch_adjust_contrast, 0.5, 1.5, 1.0),
+                   (batch_adjust_saturation, 0.5, 1.5, 1.0),
+                   (batch_adjust_hue, -0.5, 0.5, 0.0)]
+    random.shuffle(distortions)
+
+    new_images = images
+    for d, low, high, identity in distortions:
+        apply = torch.rand(n, generator = generator, device = images.device) < p
+        if not apply.any():
+            continue
+        factors = low + (high - low) * torch.rand(n, generator = generator, device = images.device)
+        factors = torch.where(apply, factors, torch.full_like(factors, identity))
+        new_images = d(new_images, factors)
+    return new_images
+
+def _flip_batch_boxes(targets, flip, size, coords):
+    """
+    Flip the boxes of the images selected by flip, with the box formulas of hflip (coords 0, 2) and vflip (coords 1, 3)
+    """
+    n_objects = torch.tensor([len(t["boxes"]) for t in targets], device = flip.device)
+    if n_objects.sum() == 0:
+        return targets
+    boxes = torch.cat([t["boxes"] for t in targets], dim = 0)
+    flip_boxes = flip.repeat_interleave(n_objects).to(boxes.device)
+    lo, hi = coords
+    offset = 1 if lo == 0 else 0
+    new_boxes = boxes.clone()
+    new_boxes[:, lo] = torch.where(flip_boxes, size - boxes[:, hi] - offset, boxes[:, lo])
+    new_boxes[:, hi] = torch.where(flip_boxes, size - boxes[:, lo] - offset, boxes[:, hi])
+    new_targets = []
+    for t, b in zip(targets, new_boxes.split(n_objects.tolist())):
+        t = dict(t)
+        t["boxes"] = b
+        new_targets.append(t)
+    return new_targets
+
+def batch_hflip(images, targets, p = 0.5, generator = None):
+    """
+    Flip each image of a batch horizontally with probability p.
+    :param images: batch of images, a tensor of dimensions (N, 3, H, W)
+    :param targets: list of N target dictionaries, holding the boxes of each image
+    :return: flipped images, targets with updated bounding box coordinates
+    """
+    flip = torch.rand(images.size(0), generator = generator, device = images.device) < p
+    new_images = torch.where(flip.view(-1, 1, 1, 1), images.flip(-1), images)
+    return new_images, _flip_batch_boxes(targets, flip, images.size(-1), (0, 2))
+
+def batch_vflip(images, targets, p = 0.5, generator = None):
+    """
+    Flip each image of a batch vertically with probability p.
+    """
+    flip = torch.rand(images.size(0), generator = generator, device = images.device) < p
+    new_images = torch.where(flip.view(-1, 1, 1, 1), images.flip(-2), images)
+    return new_images, _flip_batch_boxes(targets, flip, images.size(-2), (1, 3))
+
+def get_batch_transform(images, targets, generator = None):
+    """
+    Apply the training transformations of get_transform to a collated batch.
+    :param images: batch of float images in [0, 1], a tensor of dimensions (N, 3, H, W)
+    :param targets: list of N target dictionaries, holding the boxes of each image
+    :return: transformed images, targets with transformed bounding box coordinates
+    """
+    new_images = batch_photometric_distort(images, generator = generator)
+    new_images, new_targets = batch_hflip(new_images, targets, generator = generator)
+    new_images, new_targets = batch_vflip(new_images, new_targets, generator = generator)
+    return new_images, new_targets
+
+class BatchAugmentation(object):
+    """
+    Augmentation stage run on a collated batch in the training loop, instead of per sample in the DataLoader workers
+    (use it with a dataset made with augment = False).
+    The batch is moved to device (e.g. the training device, or the cpu of the main process) and transformed there
+    with get_batch_transform; the random parameters of each image are sampled on that device.
+    """
+    def __init__(self, device, seed = None):
+        self.device = torch.device(device)
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(device = self.device)
+            self.generator.manual_seed(seed)
+
+    def __call__(self, images, targets):
+        """
+        :param images: batch of float images in [0, 1], a tensor of dimensions (N, 3, H, W) or a list of N (3, H, W) tensors
+        :param targets: list of N target dictionaries
+        :return: the transformed images (N, 3, H, W) and targets, on device
+        """
+        if isinstance(images, (list, tuple)):
+            images = torch.stack(images, dim = 0)
+        images = images.to(self.device, non_blocking = True)
+        targets = [{k: v.to(self.device, non_blocking = True) for k, v in t.items()} for t in targets]
+        return get_batch_transform(images, targets, generator = self.generator)
+
+def normalize(statistics_path):
+    """
+    The per-channel mean and standard deviation of the dataset to use for the normalization, as computed by
+    dataset_statistics.py (streamed over every image, instead of loading the train set as a single batch)
+    :param statistics_path: the json file saved by dataset_statistics.py
+    :return: mean, std, tensors of dimensions (3)
+    """
+    with open(statistics_path, 'r') as j:
+        statistics = json.load(j)
+    return torch.tensor(statistics["mean"]), torch.tensor(statistics["std"])
 
 def get_transform(image, boxes, labels, difficulties, split):
     """